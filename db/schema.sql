@@ -9,12 +9,89 @@ CREATE TABLE message (
     op INT,
     s INT,
     t VARCHAR(255),
-    raw MEDIUMTEXT NOT NULL,
-)
+    -- Partition of the message in the analysis, see logger/partition.py.
+    part VARCHAR(255),
+    -- Length of the JSON text in bytes.
+    size INT UNSIGNED,
+    -- Name of the logger session that logged the message, if any.
+    session VARCHAR(64),
+    -- JSON text, or compressed JSON, see logger/codec.py.
+    raw MEDIUMBLOB NOT NULL,
+    INDEX (t, time),
+    INDEX (part, id),
+    INDEX (dir, op),
+    INDEX (time)
+);
+
+-- Journal segments replayed by the logger, so that a segment is never
+-- inserted twice.
+CREATE TABLE journal_segment (
+    name VARCHAR(64) KEY,
+    replayed TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Preset dictionaries for compressed raw values, keyed by the Adler-32
+-- checksum of the dictionary.
+CREATE TABLE dictionary (
+    id INT UNSIGNED KEY,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    data MEDIUMBLOB NOT NULL
+);
+
+-- Messages stored once and referenced by the SHA-256 hash of their
+-- JSON text, see logger/codec.py.  raw may be compressed.
+CREATE TABLE payload (
+    hash BINARY(32) KEY,
+    raw MEDIUMBLOB NOT NULL
+);
+
+-- Number and total size of the messages logged each minute, kept up to
+-- date by the logger and rebuilt with logger/rollup.py.  NULL t and op
+-- are stored as '' and -1 to be part of the key, minute is in UTC.
+CREATE TABLE rollup (
+    t VARCHAR(255) NOT NULL DEFAULT '',
+    dir TINYINT NOT NULL,
+    op INT NOT NULL DEFAULT -1,
+    minute DATETIME NOT NULL,
+    count INT UNSIGNED NOT NULL,
+    bytes BIGINT UNSIGNED NOT NULL,
+    PRIMARY KEY (t, dir, op, minute)
+);
+
+-- Values of selected keys in the messages by the path to them, kept up
+-- to date with logger/keyindex.py, and the highest message id indexed.
+CREATE TABLE keyindex (
+    path VARCHAR(255) NOT NULL,
+    value VARCHAR(255) NOT NULL,
+    id INT NOT NULL,
+    PRIMARY KEY (path, value, id),
+    INDEX (id)
+);
+CREATE TABLE keyindex_state (
+    last_id INT NOT NULL
+);
 
 -- You'll need to modify these to fit your setup
 CREATE USER 'logger'@'localhost' IDENTIFIED BY 'Bot password';
 GRANT SELECT, INSERT ON discord.message TO 'logger'@'localhost';
+GRANT SELECT, INSERT ON discord.journal_segment TO 'logger'@'localhost';
+GRANT SELECT, INSERT ON discord.dictionary TO 'logger'@'localhost';
+GRANT SELECT, INSERT ON discord.payload TO 'logger'@'localhost';
+GRANT SELECT, INSERT, UPDATE, DELETE ON discord.rollup TO 'logger'@'localhost';
+GRANT SELECT, INSERT, DELETE ON discord.keyindex TO 'logger'@'localhost';
+GRANT SELECT, INSERT, DELETE ON discord.keyindex_state TO 'logger'@'localhost';
+
+-- Only needed to update existing rows with codec.py migrate and
+-- backfill.py.
+GRANT UPDATE ON discord.message TO 'logger'@'localhost';
+
+-- Only needed to move old rows to the archive with archive.py.
+GRANT DELETE ON discord.message TO 'logger'@'localhost';
+GRANT DELETE ON discord.payload TO 'logger'@'localhost';
 
 CREATE USER 'web'@'localhost' IDENTIFIED BY 'Web password'
 GRANT SELECT on discord.message TO 'web'@'localhost';
+GRANT SELECT on discord.dictionary TO 'web'@'localhost';
+GRANT SELECT on discord.rollup TO 'web'@'localhost';
+GRANT SELECT on discord.payload TO 'web'@'localhost';
+GRANT SELECT on discord.keyindex TO 'web'@'localhost';
@@ -0,0 +1,80 @@
+-- Changes needed to bring a database created from an older version of
+-- schema.sql up to date.  Apply the sections newer than your database
+-- in order.
+
+-- Journal of spilled messages.
+CREATE TABLE journal_segment (
+    name VARCHAR(64) KEY,
+    replayed TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+GRANT SELECT, INSERT ON discord.journal_segment TO 'logger'@'localhost';
+
+-- Compressed raw values.
+ALTER TABLE message MODIFY raw MEDIUMBLOB NOT NULL;
+CREATE TABLE dictionary (
+    id INT UNSIGNED KEY,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    data MEDIUMBLOB NOT NULL
+);
+GRANT SELECT, INSERT ON discord.dictionary TO 'logger'@'localhost';
+GRANT SELECT on discord.dictionary TO 'web'@'localhost';
+
+-- Partition and size of messages, fill them in for existing rows with
+-- logger/backfill.py.
+ALTER TABLE message
+    ADD part VARCHAR(255) AFTER t,
+    ADD size INT UNSIGNED AFTER part,
+    ADD INDEX (t, time),
+    ADD INDEX (part, id),
+    ADD INDEX (dir, op);
+GRANT UPDATE ON discord.message TO 'logger'@'localhost';
+
+-- Archival of old messages with logger/archive.py.
+GRANT DELETE ON discord.message TO 'logger'@'localhost';
+
+-- Rollup of message counts, fill it in for existing rows with
+-- logger/rollup.py after upgrading the logger.
+CREATE TABLE rollup (
+    t VARCHAR(255) NOT NULL DEFAULT '',
+    dir TINYINT NOT NULL,
+    op INT NOT NULL DEFAULT -1,
+    minute DATETIME NOT NULL,
+    count INT UNSIGNED NOT NULL,
+    bytes BIGINT UNSIGNED NOT NULL,
+    PRIMARY KEY (t, dir, op, minute)
+);
+GRANT SELECT, INSERT, UPDATE, DELETE ON discord.rollup TO 'logger'@'localhost';
+GRANT SELECT on discord.rollup TO 'web'@'localhost';
+
+-- Deduplicated storage of large messages, enabled with dedup_size.
+CREATE TABLE payload (
+    hash BINARY(32) KEY,
+    raw MEDIUMBLOB NOT NULL
+);
+GRANT SELECT, INSERT ON discord.payload TO 'logger'@'localhost';
+GRANT SELECT on discord.payload TO 'web'@'localhost';
+
+-- Session that logged the message, for running several in one logger.
+ALTER TABLE message ADD session VARCHAR(64) AFTER size;
+
+-- Index of key values, fill it in with logger/keyindex.py update.
+CREATE TABLE keyindex (
+    path VARCHAR(255) NOT NULL,
+    value VARCHAR(255) NOT NULL,
+    id INT NOT NULL,
+    PRIMARY KEY (path, value, id),
+    INDEX (id)
+);
+CREATE TABLE keyindex_state (
+    last_id INT NOT NULL
+);
+GRANT SELECT, INSERT, DELETE ON discord.keyindex TO 'logger'@'localhost';
+GRANT SELECT, INSERT, DELETE ON discord.keyindex_state TO 'logger'@'localhost';
+GRANT SELECT on discord.keyindex TO 'web'@'localhost';
+
+-- Daily snapshots of the analysis find the messages of a day by time.
+ALTER TABLE message ADD INDEX (time);
+
+-- Payloads only archived messages referred to are deleted by
+-- logger/archive.py.
+GRANT DELETE ON discord.payload TO 'logger'@'localhost';
@@ -2,277 +2,635 @@ import sys
 import json
 import logging
 import collections
+import datetime
+import hashlib
 import html
+import multiprocessing
+import os
+import pickle
+import queue
+import re
+import threading
 
 import pymysql
 
-def partition(direction, data):
-    if direction == 0: # client receive
-        if 't' in data and data['t'] is not None:
-            if data['t'].startswith('CHANNEL') and data['d']['is_private']:
-                return '{} {}'.format(data['t'], '(private)')
-            elif data['t'] == 'GUILD_DELETE' and data['d'].get('unavailable'):
-                return '{} {}'.format(data['t'], '(unavailable)')
-            elif data['t'] == 'MESSAGE_UPDATE' and 'content' not in data['d']:
-                return '{} {}'.format(data['t'], '(embeds only)')
-            else:
-                return data['t']
-        else:
-            return 'OP {}'.format(data['op'])
-    else:
-        return None
+from archive import Archive, read_segment
+from codec import RAW_SQL, Codec, load_dictionaries
+from database import connect, load_config
+from partition import partition
+from sketch import HASH_VERSION, Stats, bucket_label
 
-def analyze(row, result):
+def analyze(row, result, trace=False):
+    row_id, direction, raw = row
     try:
-        d = json.loads(row['raw'])
+        d = json.loads(raw)
     except json.decoder.JSONDecodeError:
-        print("error decoding", row['id'], file=sys.stderr)
+        print("error decoding", row_id, file=sys.stderr)
         return
 
-    part = partition(row['dir'], d)
+    part = partition(direction, d)
     if part is None:
         return
 
-    sub_analyze(result[part], d)
+    if trace:
+        trace_analyze(result[part], d)
+    else:
+        sub_analyze(result[part], d)
+
+class Node:
+    """Statistics for one position in the messages of a partition.
+
+    values counts the first values seen, until there are more than 10
+    distinct values.  From then on strings and ints are no longer
+    counted, and their types are added to capped.  stats has statistics
+    of all the values seen, which take the same space however many
+    values there are.
+
+    Containers are only allocated once a node has something to put in
+    them, so values, capped, stats, nodes, leafs, snowflake_leafs and
+    trace are None until then.
+    """
+
+    __slots__ = ('count', 'types', 'values', 'capped', 'stats',
+                 'nodes', 'leafs', 'snowflake_leafs', 'leaf_count', 'trace')
+
+    def __init__(self):
+        self.count = 0
+        self.types = {}
+        self.values = None
+        self.capped = None
+        self.stats = None
+        self.nodes = None
+        self.leafs = None
+        self.snowflake_leafs = None
+        self.leaf_count = 0
+        self.trace = None
+
+    # Pickled as a tuple, the default state repeats the name of every
+    # slot for every node.
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in Node.__slots__)
+
+    def __setstate__(self, state):
+        if len(state) == 11:
+            # Older layout with charset, min and max instead of capped
+            # and stats.
+            count, types, values, charset, low = state[:5]
+            state = (count, types, values, capped_types(charset, low),
+                     None) + state[6:]
+        for name, value in zip(Node.__slots__, state):
+            setattr(self, name, value)
+
+    def child(self, name):
+        if self.nodes is None:
+            self.nodes = {}
+        node = self.nodes.get(name)
+        if node is None:
+            node = self.nodes[name] = Node()
+        return node
+
+    def leaf(self, snowflake=False):
+        if snowflake:
+            if self.snowflake_leafs is None:
+                self.snowflake_leafs = Node()
+            return self.snowflake_leafs
+        if self.leafs is None:
+            self.leafs = Node()
+        return self.leafs
+
+    def get_values(self):
+        if self.values is None:
+            self.values = {}
+        return self.values
+
+    def get_stats(self):
+        if self.stats is None:
+            self.stats = Stats()
+        return self.stats
+
+    def cap(self, t):
+        if self.capped is None:
+            self.capped = set()
+        self.capped.add(t)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Convert a node from the nested dicts of older result files."""
+        node = cls()
+        node.count = data['count']
+        node.types = dict(data['types'])
+        if 'values' in data:
+            node.values = dict(data['values'])
+        node.capped = capped_types(data.get('charset'), data.get('min'))
+        if 'nodes' in data:
+            node.nodes = {k: cls.from_dict(v)
+                          for k, v in data['nodes'].items()}
+        for k in ('leafs', 'snowflake_leafs'):
+            if k in data:
+                setattr(node, k, cls.from_dict(data[k]))
+        node.leaf_count = data.get('leaf_count', 0)
+        return node
+
+def capped_types(charset, low):
+    # Older versions kept the characters of the strings and the range of
+    # the ints once they were no longer counted.
+    capped = set()
+    if charset is not None:
+        capped.add('str')
+    if low is not None:
+        capped.add('int')
+    return capped or None
+
+def new_result():
+    return collections.defaultdict(Node)
 
 def sub_analyze(node, leaf, snoflake=False):
-    node['count'] = node.get('count', 0) + 1
+    node.count += 1
 
     t = type(leaf).__name__
-    node['types'][t] = node['types'].get(t, 0) + 1
+    types = node.types
+    types[t] = types.get(t, 0) + 1
 
     if t == 'dict':
         for k, v in leaf.items():
-            sub_analyze(node['nodes'][k], v, k=='guilds')
+            sub_analyze(node.child(k), v, k=='guilds')
     elif t == 'list':
         for v in leaf:
-            node['leaf_count'] = node.get('leaf_count', 0) + 1
-            if snoflake and v.get('unavailable'):
-                sub_analyze(node['snowflake_leafs'], v)
-            else:
-                sub_analyze(node['leafs'], v)
-    elif t == 'str':
-        if 'charset' in node:
-            node['charset'].update(list(leaf))
-        elif len(node['values']) > 10:
-            node['charset'] = set(list(leaf))
-            for k in list(node['values'].keys()):
-                if type(k) == str:
-                    node['charset'].update(list(k))
-        else:
-            node['values'][leaf] = node['values'].get(leaf, 0) + 1
-
-    elif t == 'int':
-        if 'min' in node:
-            node['min'] = min(node['min'], leaf)
-            node['max'] = max(node['max'], leaf)
-        elif len(node['values']) > 10:
-            values = [v for v in node['values'] if type(v) == int]
-            values.append(leaf)
-            node['min'] = min(values)
-            node['max'] = max(values)
+            node.leaf_count += 1
+            sub_analyze(node.leaf(snoflake and v.get('unavailable')), v)
+    else:
+        add_value(node, t, leaf)
+
+def add_value(node, t, leaf, stats=True):
+    values = node.get_values()
+    if stats:
+        # Hashing the value for the statistics can be skipped if it is
+        # already counted.  The keys of values do not tell apart True
+        # and 1 or False and 0, so those are always hashed.
+        new = leaf not in values or (t != 'str' and leaf in (0, 1))
+        node.get_stats().add(t, leaf, new)
+
+    if t == 'str' or t == 'int':
+        if node.capped is not None and t in node.capped:
+            pass
+        elif len(values) > 10:
+            node.cap(t)
         else:
-            node['values'][leaf] = node['values'].get(leaf, 0) + 1
+            values[leaf] = values.get(leaf, 0) + 1
     elif t == 'bool' or t == 'NoneType':
-        node['values'][leaf] = node['values'].get(leaf, 0) + 1
+        values[leaf] = values.get(leaf, 0) + 1
+    else:
+        raise ValueError("Unknown type %s" % t)
+
+# Parallel analysis builds partial results for ranges of rows, which are
+# merged in row order.  A partial result has the same structure as a
+# result, except that the values seen by a node are kept in a Trace.
+
+def trace_analyze(node, leaf, snoflake=False):
+    node.count += 1
+
+    t = type(leaf).__name__
+    types = node.types
+    types[t] = types.get(t, 0) + 1
+
+    if t == 'dict':
+        for k, v in leaf.items():
+            trace_analyze(node.child(k), v, k=='guilds')
+    elif t == 'list':
+        for v in leaf:
+            node.leaf_count += 1
+            trace_analyze(node.leaf(snoflake and v.get('unavailable')), v)
     else:
-        raise ValueError("Unknown type %" % t)
+        if node.trace is None:
+            node.trace = Trace()
+        node.trace.add(t, leaf)
+
+class Trace:
+    """Values seen by a node, kept so they can be replayed with add_value.
+
+    How add_value counts a value depends on the values before it, but
+    only until the node has seen more than 10 distinct values.  Before
+    that, the first occurrence of a value and the first str and int
+    after it are kept as (type, value) tuples, and the values between
+    them as dicts of counts.  Replaying the counts in bulk gives the
+    same node as adding the values one at a time, whatever values the
+    node had before.  After that, everything goes into a Tail.
 
-def post_analyze(result):
-    print(open('header.html').read(), end='')
+    The statistics of the values do not depend on their order, and are
+    kept separately in stats.
+    """
+
+    def __init__(self):
+        self.seen = set()
+        self.typed = set()
+        self.chunks = []
+        self.need_str = False
+        self.need_int = False
+        self.tail = None
+        self.stats = Stats()
+
+    def add(self, t, leaf):
+        if t not in ('str', 'int', 'bool', 'NoneType'):
+            raise ValueError("Unknown type %s" % t)
+
+        if self.tail is not None:
+            self.stats.add(t, leaf)
+            self.tail.add(t, leaf)
+            return
+
+        # True == 1 and False == 0, so values are told apart by type.
+        key = (t, leaf)
+        new = key not in self.typed
+        self.stats.add(t, leaf, new)
+        if new:
+            self.typed.add(key)
+            self.seen.add(leaf)
+            self.chunks.append(key)
+            self.need_str = True
+            self.need_int = True
+            if len(self.seen) > 10:
+                self.tail = Tail()
+
+        elif t == 'str' and self.need_str:
+            self.need_str = False
+            self.chunks.append(key)
+
+        elif t == 'int' and self.need_int:
+            self.need_int = False
+            self.chunks.append(key)
+
+        else:
+            if not self.chunks or type(self.chunks[-1]) is not dict:
+                self.chunks.append({})
+            counts = self.chunks[-1]
+            counts[key] = counts.get(key, 0) + 1
+
+    def replay(self, node):
+        for chunk in self.chunks:
+            if type(chunk) is tuple:
+                add_value(node, chunk[0], chunk[1], False)
+                continue
+
+            values = node.get_values()
+            capped = node.capped or ()
+            for (t, leaf), count in chunk.items():
+                if t not in capped:
+                    values[leaf] = values.get(leaf, 0) + count
+
+        if self.tail is not None:
+            self.tail.replay(node)
+        node.get_stats().merge(self.stats)
+
+class Tail:
+    """Values seen after a node has seen more than 10 distinct values.
+
+    From then on no str or int is added to the values of the node, so
+    only which of them were seen and the counts of the other values are
+    needed.
+    """
+
+    def __init__(self):
+        self.capped = set()
+        self.counts = {}
+
+    def add(self, t, leaf):
+        if t == 'str' or t == 'int':
+            self.capped.add(t)
+        else:
+            key = (t, leaf)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def replay(self, node):
+        values = node.get_values()
+        for t in self.capped:
+            node.cap(t)
+
+        for (t, leaf), count in self.counts.items():
+            values[leaf] = values.get(leaf, 0) + count
+
+def merge(node, part):
+    """Merge a partial result for the rows following those in node."""
+    node.count += part.count
+    for t, count in part.types.items():
+        node.types[t] = node.types.get(t, 0) + count
+
+    node.leaf_count += part.leaf_count
+    if part.nodes is not None:
+        for k, sub_part in part.nodes.items():
+            merge(node.child(k), sub_part)
+    if part.snowflake_leafs is not None:
+        merge(node.leaf(True), part.snowflake_leafs)
+    if part.leafs is not None:
+        merge(node.leaf(), part.leafs)
+
+    if part.trace is not None:
+        part.trace.replay(node)
+
+def merge_result(result, partial):
+    for name, part in partial.items():
+        merge(result[name], part)
+
+def post_analyze(result, out=None):
+    """Write the result as an HTML page to out, stdout by default."""
+    if out is None:
+        out = sys.stdout
+    write = out.write
+    write(open('header.html').read())
 
     indent = '    '*3
-    print('{}<h2>Partitions</h2>'.format(indent))
-    print('{}<ul>'.format(indent))
+    write('{}<h2>Partitions</h2>\n'.format(indent))
+    write('{}<ul>\n'.format(indent))
     for name in sorted(result.keys()):
-        print('{dt}    <li><a href="#{n}">{n}</a></li>'
+        write('{dt}    <li><a href="#{n}">{n}</a></li>\n'
               ''.format(dt=indent, n=name))
-    print('{}</ul>'.format(indent))
+    write('{}</ul>\n'.format(indent))
 
     for name in sorted(result.keys()):
-        part = result[name]
-        print('{dt}<div class="panel panel-default">\n'
-              '{dt}    <div class="panel-heading">\n'
-              '{dt}        <h3 id="{name}" class="panel-title">{name}{ht}</h3>\n'
-              '{dt}    </div>\n'
-              '{dt}    <div class="panel-body">'
-              ''.format(dt=indent, name=name, ht=headertags(part)))
+        output_partition(name, result[name], out)
+
+    write(open('footer.html').read())
+
+def output_partition(name, part, out):
+    write = out.write
+    indent = '    '*3
+    write('{dt}<div class="panel panel-default">\n'
+          '{dt}    <div class="panel-heading">\n'
+          '{dt}        <h3 id="{name}" class="panel-title">{name}{ht}</h3>\n'
+          '{dt}    </div>\n'
+          '{dt}    <div class="panel-body">\n'
+          ''.format(dt=indent, name=name, ht=headertags(part)))
+
+    write('<pre class="infoblock">')
+
+    lines = flatten_prop(part, part.count)
+    output_node(lines, out)
+
+    write('</pre>\n')
+
+    write('{dt}    </div>\n'
+          '{dt}</div>\n'.format(dt=indent))
+
+# Pages are only written again when the hash of what is on them changes.
+# Bump this when changing how the pages look to have them all written.
+PAGE_VERSION = 1
+
+def page_name(name):
+    return 'analysis-{}.html'.format(re.sub('[^A-Za-z0-9_]+', '-', name)
+                                     .strip('-'))
+
+def node_hash(digest, node):
+    """Update digest with everything about node that is rendered."""
+    stats = node.stats
+    if stats is not None:
+        stats = (stats.distinct(), stats.sample_values(),
+                 sorted(stats.lengths.items()), stats.min, stats.max)
+    digest.update(repr((node.count, node.types, node.values, node.leaf_count,
+                        stats)).encode('utf-8'))
+
+    if node.nodes is not None:
+        for name in sorted(node.nodes):
+            digest.update(repr(name).encode('utf-8'))
+            node_hash(digest, node.nodes[name])
+    for leafs in (node.snowflake_leafs, node.leafs):
+        digest.update(b'[' if leafs is not None else b'-')
+        if leafs is not None:
+            node_hash(digest, leafs)
+
+def page_hash(name, part, template):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((PAGE_VERSION, name, template)).encode('utf-8'))
+    node_hash(digest, part)
+    return digest.hexdigest()
 
-        print('<pre class="infoblock">', end='')
+def read_page_hash(path):
+    try:
+        with open(path, encoding='utf-8') as page:
+            line = page.readline()
+    except FileNotFoundError:
+        return None
+    match = re.match('<!-- analysis page ([0-9a-f]+) -->', line)
+    return match.group(1) if match else None
+
+def render_pages(result, directory):
+    """Write a page per partition and an index page to directory.
+
+    Pages of partitions that have not changed since they were written
+    are skipped.  Returns the number of pages written and skipped.
+    """
+    header = open('header.html').read()
+    footer = open('footer.html').read()
+    indent = '    '*3
+    written = skipped = 0
 
-        lines = flatten_prop(part, part['count'])
-        output_node(lines)
+    pages = {name: page_name(name) for name in result}
+    for name in sorted(result):
+        part = result[name]
+        path = os.path.join(directory, pages[name])
+        digest = page_hash(name, part, header + footer)
+        if read_page_hash(path) == digest:
+            skipped += 1
+            continue
+
+        with open(path + '.tmp', 'w', encoding='utf-8') as out:
+            out.write('<!-- analysis page {} -->\n'.format(digest))
+            out.write(header)
+            out.write('{}<p><a href="analysis.html">All partitions</a></p>\n'
+                      ''.format(indent))
+            output_partition(name, part, out)
+            out.write(footer)
+        os.replace(path + '.tmp', path)
+        written += 1
 
-        print('</pre>')
+    with open(os.path.join(directory, 'analysis.html.tmp'), 'w',
+              encoding='utf-8') as out:
+        out.write(header)
+        out.write('{}<h2>Partitions</h2>\n'.format(indent))
+        out.write('{}<ul>\n'.format(indent))
+        for name in sorted(result):
+            out.write('{dt}    <li><a href="{p}">{n}</a>{ht}</li>\n'
+                      ''.format(dt=indent, p=pages[name], n=name,
+                                ht=headertags(result[name])))
+        out.write('{}</ul>\n'.format(indent))
+        out.write(footer)
+    os.replace(os.path.join(directory, 'analysis.html.tmp'),
+               os.path.join(directory, 'analysis.html'))
 
-        print('{dt}    </div>\n'
-              '{dt}</div>'.format(dt=indent))
+    # Remove the pages of partitions that are no longer in the result.
+    current = set(pages.values())
+    for page in os.listdir(directory):
+        path = os.path.join(directory, page)
+        if (page.startswith('analysis-') and page not in current
+                and read_page_hash(path) is not None):
+            os.remove(path)
 
-    print(open('footer.html').read(), end='')
+    return written, skipped
 
 def flatten_prop(node, top_count, name=None, indent=''):
-    if len(node) == 0:
+    """Generate the lines of a node and of the nodes below it."""
+    if node.count == 0:
         raise TypeError("empty node")
-    is_obj = 'dict' in node['types']
-    is_array = 'list' in node['types']
+    is_obj = 'dict' in node.types
+    is_array = 'list' in node.types
     if is_obj and is_array:
         raise TypeError("unsupported dual obj, array node")
     elif is_array and name is None:
         raise TypeError("unsupported nested array node")
 
-    lines = []
-    data = {k:v for k, v in node.items() if k not in ('nodes', 'leafs')}
-    data['top_count'] = top_count
+    data = {'node': node, 'top_count': top_count}
     sub_indent = ''.join([indent, '    '])
+    sub_nodes = node.nodes if node.nodes is not None else {}
 
     if is_obj:
         if name is None:
-            lines = [{'line_type': 'obj_start', 'indent': indent,
-                      'data': data}]
-            for sub_name in sorted(node['nodes']):
-                sub_node = node['nodes'][sub_name]
-                lines.extend(flatten_prop(sub_node, node['count'], sub_name,
-                                          sub_indent))
-            lines.append({'line_type': 'obj_end', 'indent': indent})
+            yield {'line_type': 'obj_start', 'indent': indent, 'data': data}
+            for sub_name in sorted(sub_nodes):
+                sub_node = sub_nodes[sub_name]
+                yield from flatten_prop(sub_node, node.count, sub_name,
+                                        sub_indent)
+            yield {'line_type': 'obj_end', 'indent': indent}
         else:
-            lines.append({'line_type': 'prop_obj_start', 'name': name,
-                          'data': data, 'indent': indent})
-            for sub_name in sorted(node['nodes']):
-                sub_node = node['nodes'][sub_name]
-                lines.extend(flatten_prop(sub_node, node['count'], sub_name,
-                                          sub_indent))
-            lines.append({'line_type': 'prop_obj_end', 'indent': indent})
+            yield {'line_type': 'prop_obj_start', 'name': name,
+                   'data': data, 'indent': indent}
+            for sub_name in sorted(sub_nodes):
+                sub_node = sub_nodes[sub_name]
+                yield from flatten_prop(sub_node, node.count, sub_name,
+                                        sub_indent)
+            yield {'line_type': 'prop_obj_end', 'indent': indent}
 
     elif is_array:
-        if 'snowflake_leafs' in node:
-            lines.append({'line_type': 'prop_array_start', 'name': name,
-                          'data': data, 'indent': indent})
-            lines.extend(flatten_prop(node['snowflake_leafs'],
-                         node['leaf_count'], None, sub_indent))
-            lines.append({'line_type': 'prop_array_alt', 'indent': indent})
-            lines.extend(flatten_prop(node['leafs'], node['leaf_count'], None,
-                         sub_indent))
-            lines.append({'line_type': 'prop_array_end', 'indent': indent})
-        elif 'leafs' in node:
-            lines.append({'line_type': 'prop_array_start', 'name': name,
-                          'data': data, 'indent': indent})
-            lines.extend(flatten_prop(node['leafs'], node['leaf_count'], None,
-                         sub_indent))
-            lines.append({'line_type': 'prop_array_end', 'indent': indent})
+        if node.snowflake_leafs is not None:
+            yield {'line_type': 'prop_array_start', 'name': name,
+                   'data': data, 'indent': indent}
+            yield from flatten_prop(node.snowflake_leafs, node.leaf_count,
+                                    None, sub_indent)
+            yield {'line_type': 'prop_array_alt', 'indent': indent}
+            yield from flatten_prop(node.leaf(), node.leaf_count, None,
+                                    sub_indent)
+            yield {'line_type': 'prop_array_end', 'indent': indent}
+        elif node.leafs is not None:
+            yield {'line_type': 'prop_array_start', 'name': name,
+                   'data': data, 'indent': indent}
+            yield from flatten_prop(node.leafs, node.leaf_count, None,
+                                    sub_indent)
+            yield {'line_type': 'prop_array_end', 'indent': indent}
         else:
-            lines.append({'line_type': 'prop_empty_array', 'name': name,
-                          'data': data, 'indent': indent})
+            yield {'line_type': 'prop_empty_array', 'name': name,
+                   'data': data, 'indent': indent}
 
     else:
         if name is None:
-            lines.append({'line_type': 'value', 'data': data, 'indent': indent})
+            yield {'line_type': 'value', 'data': data, 'indent': indent}
         else:
-            lines.append({'line_type': 'prop', 'name': name, 'indent': indent,
-                          'data': data})
-
-    return lines
+            yield {'line_type': 'prop', 'name': name, 'indent': indent,
+                   'data': data}
 
-def output_node(lines):
+def output_node(lines, out):
+    write = out.write
     for line in lines:
         t = line['line_type']
         indent = line['indent']
         if t == 'obj_start':
-            print('<div class="infoline">{}{{</div>'.format(indent))
+            write('<div class="infoline">{}{{</div>\n'.format(indent))
         elif t == 'obj_end':
-            print('<div class="infoline">{}}}</div>'.format(indent))
+            write('<div class="infoline">{}}}</div>\n'.format(indent))
         elif t == 'prop_obj_start':
             data = line['data']
             box = infobox(data)
             tags = infotags(data)
+            node = data['node']
             name = line['name']
-            if 'values' in data:
+            if node.values is not None:
                 raise ValueError('unhandled dual object, noed in output_node')
             else:
-                print('<div class="infoline">'
+                write('<div class="infoline">'
                           '<div class="expandline">'
                               '{}<span class="key">"{}"</span>: {{{}'
                           '</div>'
                           '{}'
-                      '</div>'.format(indent, name, tags, box))
+                      '</div>\n'.format(indent, name, tags, box))
         elif t == 'prop_obj_end':
-            print('<div class="infoline">{}}}</div>'.format(indent))
+            write('<div class="infoline">{}}}</div>\n'.format(indent))
         elif t == 'prop_array_start':
             data = line['data']
             box = infobox(data)
             tags = infotags(data)
+            node = data['node']
             name = line['name']
-            if 'values' in data:
+            if node.values is not None:
                 raise ValueError('unhandled dual array object in output_node')
             else:
-                print('<div class="infoline">'
+                write('<div class="infoline">'
                           '<div class="expandline">'
                               '{}<span class="key">"{}"</span>: [{}'
                           '</div>'
                           '{}'
-                      '</div>'.format(indent, name, tags, box))
+                      '</div>\n'.format(indent, name, tags, box))
         elif t == 'prop_array_end':
-            print('<div class="infoline">{}    ...</div>'.format(indent))
-            print('<div class="infoline">{}]</div>'.format(indent))
+            write('<div class="infoline">{}    ...</div>\n'.format(indent))
+            write('<div class="infoline">{}]</div>\n'.format(indent))
         elif t == 'prop_array_alt':
-            print('<div class="infoline">'
+            write('<div class="infoline">'
                       '{}    <span class="type-or">or</span>'
-                  '</div>'.format(indent))
+                  '</div>\n'.format(indent))
         elif t == 'prop_empty_array':
             data = line['data']
             box = infobox(data)
             tags = infotags(data)
+            node = data['node']
             name = line['name']
-            if 'values' in data:
+            if node.values is not None:
                 raise ValueError('unhandled dual array object in output_node')
             else:
-                print('<div class="infoline">'
+                write('<div class="infoline">'
                           '<div class="expandline">'
                               '{}<span class="key">"{}"</span>: []{}'
                           '</div>'
                           '{}'
-                      '</div>'.format(indent, name, tags, box))
+                      '</div>\n'.format(indent, name, tags, box))
         elif t == 'value':
             data = line['data']
             box = infobox(data)
             tags = infotags(data)
-            if len(data['values']) == 1:
-                value = next(iter(data['values'].keys()))
-                print('<div class="infoline">'
+            node = data['node']
+            if len(node.values) == 1:
+                value = next(iter(node.values.keys()))
+                write('<div class="infoline">'
                           '<div class="expandline">'
                               '{}{}{}'
                           '</div>'
                           '{}'
-                      '</div>'.format(indent, json_value(value), tags,
+                      '</div>\n'.format(indent, json_value(value), tags,
                                       box))
             else:
-                print('<div class="infoline">'
+                write('<div class="infoline">'
                           '<div class="expandline">'
                               '{}{}{}'
                           '</div>'
                           '{}'
-                      '</div>'.format(indent, json_types(data['types']),
+                      '</div>\n'.format(indent, json_types(node.types),
                                       tags, box))
         elif t == 'prop':
             data = line['data']
             box = infobox(data)
             tags = infotags(data)
+            node = data['node']
             name = line['name']
-            if len(data['values']) == 1:
-                value = next(iter(data['values'].keys()))
-                print('<div class="infoline">'
+            if len(node.values) == 1:
+                value = next(iter(node.values.keys()))
+                write('<div class="infoline">'
                           '<div class="expandline">'
                               '{}<span class="key">"{}"</span>: {}{}'
                           '</div>'
                           '{}'
-                      '</div>'.format(indent, name, json_value(value), tags,
+                      '</div>\n'.format(indent, name, json_value(value), tags,
                                       box))
             else:
-                print('<div class="infoline">'
+                write('<div class="infoline">'
                           '<div class="expandline">'
                               '{}<span class="key">"{}"</span>: {}{}'
                           '</div>'
                           '{}'
-                      '</div>'.format(indent, name, json_types(data['types']),
+                      '</div>\n'.format(indent, name, json_types(node.types),
                                       tags, box))
         else:
             raise ValueError("Unkown line type '%s'" % t)
@@ -312,62 +670,87 @@ def json_types(types):
     return ' <span class="type-or">or</span> '.join(list_of_types)
 
 def headertags(part):
-    if part['count'] < 10:
+    if part.count < 10:
         return ' <span class="label label-danger">very few samples</span>'
-    elif part['count'] < 100:
+    elif part.count < 100:
         return ' <span class="label label-warning">few samples</span>'
     else:
         return ''
 
 def infotags(data):
-    if data['count'] < data['top_count']:
+    if data['node'].count < data['top_count']:
         return ' <span class="label label-default">optional</span>'
-    elif data['count'] > data['top_count']:
+    elif data['node'].count > data['top_count']:
         return ' <span class="label label-danger">count error</span>'
     else:
         return ''
 
 def infobox(data):
     sections = []
+    node = data['node']
 
-    text = 'Samples {}'.format(data['count'])
-    if data['count'] == data['top_count']:
+    text = 'Samples {}'.format(node.count)
+    if node.count == data['top_count']:
         text += ', always present.'
     else:
-        percent = data['count'] / data['top_count'] * 100
+        percent = node.count / data['top_count'] * 100
         text += ', present in {:.2f}% of samples'.format(percent)
 
     sections.append(("Info", text))
 
-    if 'values' not in data:
+    if node.values is None:
         pass
         #raise ValueError('infobox data with no values!')
-    elif len(data['values']) == 1:
+    elif len(node.values) == 1:
         pass
-    elif len(data['values']) < 10:
-        section = ''
-        for value, count in data['values'].items():
+    elif len(node.values) < 10:
+        items = []
+        for value, count in node.values.items():
             if count > 1:
-                section += ('<li>{} {} times</li>'
-                            ''.format(json_value(value), count))
+                items.append('<li>{} {} times</li>'
+                             ''.format(json_value(value), count))
             else:
-                section += '<li>{} one time</li>'.format(json_value(value))
+                items.append('<li>{} one time</li>'.format(json_value(value)))
 
-        section = '<ul>{}</ul>'.format(section)
+        section = '<ul>{}</ul>'.format(''.join(items))
         sections.append(("Values Observed", section))
     else:
-        section = ''
-        for value in data['values']:
-            section += '<li>{}</li>'.format(json_value(value))
-
-        section = '<ul>{}</ul>'.format(section)
+        if node.stats is not None:
+            sample = node.stats.sample_values()
+        else:
+            sample = node.values
+        items = ['<li>{}</li>'.format(json_value(value)) for value in sample]
+        section = '<ul>{}</ul>'.format(''.join(items))
         sections.append(("Sample Values", section))
 
+    if node.stats is not None and len(node.values) > 1:
+        sections.append(("Statistics", statistics(node.stats)))
+
     sections = ''.join(['<h4>{}</h4>{}'.format(t, s) for t, s in sections])
     return ('<div class="panel panel-default infobox" style="display: none;">'
                 '<div class="panel-body">{}</div>'
             '</div>'.format(sections))
 
+def statistics(stats):
+    distinct, exact = stats.distinct()
+    if exact:
+        items = ['<li>{} distinct values</li>'.format(distinct)]
+    else:
+        items = ['<li>About {} distinct values</li>'.format(distinct)]
+
+    if stats.min is not None:
+        items.append('<li>Integers from {} to {}</li>'
+                     ''.format(json_value(stats.min), json_value(stats.max)))
+
+    if stats.lengths:
+        lengths = ['<li>{}: {} strings</li>'
+                   ''.format(bucket_label(bucket), stats.lengths[bucket])
+                   for bucket in sorted(stats.lengths)]
+        items.append('<li>String lengths<ul>{}</ul></li>'
+                     ''.format(''.join(lengths)))
+
+    return '<ul>{}</ul>'.format(''.join(items))
+
 class SetEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, set):
@@ -375,51 +758,424 @@ class SetEncoder(json.JSONEncoder):
         else:
             return json.JSONEncoder.default(self, obj)
 
+# Result files from older versions are made of these.
 def defaultdict_factory():
     return collections.defaultdict(defaultdict_factory)
 
 
+# Rows are streamed from the server in chunks of FETCH_ROWS, with at
+# most QUEUE_CHUNKS chunks waiting to be analyzed, so the memory used
+# does not depend on the number of rows.
+FETCH_ROWS = 1000
+QUEUE_CHUNKS = 8
+
+# Seconds the server waits on a client that is slow to read a streamed
+# result before giving up on it.
+STREAM_TIMEOUT = 600
+
+def read_rows(connection, codec, where):
+    """Generate the (id, dir, raw) rows matching where in id order.
+
+    The rows are fetched and decoded by a reader thread while the
+    caller works on the rows before them.
+    """
+    sql = ("SELECT id, dir, {} FROM message WHERE {} ORDER BY id"
+           "".format(RAW_SQL, where))
+    chunks = queue.Queue(QUEUE_CHUNKS)
+    done = threading.Event()
+
+    def reader():
+        try:
+            with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+                cursor.execute("SET SESSION net_write_timeout = %s",
+                               (STREAM_TIMEOUT,))
+                cursor.execute(sql)
+                while not done.is_set():
+                    rows = cursor.fetchmany(FETCH_ROWS)
+                    if not rows:
+                        break
+                    chunks.put([(i, d, codec.decode(r)) for i, d, r in rows])
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield from chunk
+    finally:
+        # Unblock the reader if the caller stopped early.
+        done.set()
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def analyze_rows(connection, codec, where, result, trace=False):
+    for row in read_rows(connection, codec, where):
+        analyze(row, result, trace)
+
+def analyze_range(task):
+    config, where, low, high = task
+    connection = connect(config)
+    codec = Codec(load_dictionaries(connection))
+
+    partial = new_result()
+    where = 'id >= {:d} AND id < {:d} AND ({})'.format(low, high, where)
+    analyze_rows(connection, codec, where, partial, True)
+    connection.close()
+    return partial
+
+def analyze_segment(task):
+    path, low, parts = task
+    partial = new_result()
+    for row in read_segment(path, low):
+        if parts is None or row[6] in parts:
+            analyze((row[0], row[2], row[8]), partial, True)
+    return partial
+
+def prepare(config, where, jobs=1, result=None, watermark=0, archive=None,
+            parts=None):
+    """Analyze the rows with an id above watermark into result.
+
+    If archive is given the archived rows are analyzed before the rows
+    in the table, only the ones in parts if it is given.  Returns the
+    result and the new watermark, the highest id that was in the table
+    or the archive when the analysis started.
+    """
+    if result is None:
+        result = new_result()
+    connection = connect(config)
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MAX(id) FROM message")
+        high = cursor.fetchone()[0] or 0
+
+    # Archived rows may still be in the table if the archival was
+    # interrupted, the table is only read from after the archive.
+    low = watermark
+    segments = []
+    if archive is not None:
+        segments = archive.segments_after(watermark)
+        low = max(watermark, archive.last_id)
+        high = max(high, archive.last_id)
+    if high <= watermark:
+        connection.close()
+        return result, watermark
+
+    if jobs == 1:
+        for path in segments:
+            for row in read_segment(path, watermark):
+                if parts is None or row[6] in parts:
+                    analyze((row[0], row[2], row[8]), result)
+        if high > low:
+            codec = Codec(load_dictionaries(connection))
+            where = 'id > {:d} AND id <= {:d} AND ({})'.format(low, high,
+                                                              where)
+            analyze_rows(connection, codec, where, result)
+        connection.close()
+        return result, high
+    connection.close()
+
+    # More ranges than processes evens out ranges that are slow.
+    start, end = low + 1, high + 1
+    count = jobs * 4
+    bounds = [start + (end - start) * i // count for i in range(count + 1)]
+    tasks = [(config, where, l, h) for l, h in zip(bounds, bounds[1:]) if l < h]
+    segment_tasks = [(path, watermark, parts) for path in segments]
+
+    # Partial results are merged in the order of their ranges, which
+    # gives the same result as analyzing all the rows in order.
+    with multiprocessing.Pool(jobs) as pool:
+        for partial in pool.imap(analyze_segment, segment_tasks):
+            merge_result(result, partial)
+        for partial in pool.imap(analyze_range, tasks):
+            merge_result(result, partial)
+    return result, high
+
+def load_result(path):
+    """Load a result file, and the information stored with it if any."""
+    with open(path, 'rb') as result_file:
+        result = pickle.load(result_file)
+        try:
+            info = pickle.load(result_file)
+        except EOFError:
+            info = {}
+
+    if result.default_factory is not Node:
+        result = collections.defaultdict(Node, {
+            name: Node.from_dict(part) if isinstance(part, dict) else part
+            for name, part in result.items()})
+    return result, info
+
+def save_result(path, result, info):
+    # The info is pickled after the result, so a file can be rendered
+    # without it.
+    with open(path + '.tmp', 'wb') as result_file:
+        pickle.dump(result, result_file)
+        pickle.dump(info, result_file)
+    os.replace(path + '.tmp', path)
+
+# Daily snapshots are partial results of all the messages logged on a
+# day in UTC, which are merged in day order to analyze a range of days.
+# Snapshots are only kept for days that have ended, and are made again
+# if more messages have been logged on their day since, as happens when
+# a journal is replayed.  Messages archived since don't count.  The
+# version changes with HASH_VERSION, as the statistics of snapshots with
+# different hashes can't be merged.
+SNAPSHOT_VERSION = 2
+
+def day_range(first, last):
+    day = datetime.datetime.strptime(first, '%Y-%m-%d')
+    end = datetime.datetime.strptime(last, '%Y-%m-%d')
+    while day <= end:
+        yield day.strftime('%Y-%m-%d')
+        day += datetime.timedelta(days=1)
+
+def analyze_day(task):
+    config, day, segments, low = task
+    partial = new_result()
+    for path in segments:
+        for row in read_segment(path):
+            analyze((row[0], row[2], row[8]), partial, True)
+
+    # Rows that are also in the archive are left out.
+    start = datetime.datetime.strptime(day, '%Y-%m-%d')
+    where = "time >= '{}' AND time < '{}' AND id > {:d}".format(
+        start, start + datetime.timedelta(days=1), low)
+    connection = connect(config)
+    codec = Codec(load_dictionaries(connection))
+    analyze_rows(connection, codec, where, partial, True)
+    connection.close()
+    return partial
+
+def snapshot_info(path):
+    try:
+        with open(path, 'rb') as snapshot_file:
+            return pickle.load(snapshot_file)
+    except FileNotFoundError:
+        return None
+
+def load_snapshot(path):
+    with open(path, 'rb') as snapshot_file:
+        pickle.load(snapshot_file)
+        return pickle.load(snapshot_file)
+
+def save_snapshot(path, partial, info):
+    # The info is pickled before the partial result, so it can be
+    # checked without loading the result.
+    with open(path + '.tmp', 'wb') as snapshot_file:
+        pickle.dump(info, snapshot_file)
+        pickle.dump(partial, snapshot_file)
+    os.replace(path + '.tmp', path)
+
+def prepare_days(config, first, last, directory, jobs=1, archive=None,
+                 parts=None):
+    """Analyze the messages logged from day first to day last.
+
+    Days are read from their snapshot in directory, and the days without
+    one are analyzed, including the messages archived on them if archive
+    is given.  Only the partitions in parts are in the result if it is
+    given.  Returns the result and the number of days analyzed.
+    """
+    os.makedirs(directory, exist_ok=True)
+    days = list(day_range(first, last))
+    today = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+
+    connection = connect(config)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT DATE(time), COUNT(*) FROM message "
+                       "WHERE time >= %s AND time < %s GROUP BY 1",
+                       (days[0], datetime.datetime.strptime(days[-1],
+                        '%Y-%m-%d') + datetime.timedelta(days=1)))
+        counts = {str(day): count for day, count in cursor.fetchall()}
+    connection.close()
+
+    low = 0
+    segments = collections.defaultdict(list)
+    if archive is not None:
+        low = archive.last_id
+        for segment in archive.segments:
+            segments[segment['day']].append(
+                os.path.join(archive.path, segment['file']))
+            counts[segment['day']] = (counts.get(segment['day'], 0)
+                                      + segment['rows'])
+
+    missing = []
+    for day in days:
+        info = snapshot_info(os.path.join(directory, day + '.pickle'))
+        if (day >= today or info is None
+                or info['version'] != SNAPSHOT_VERSION
+                or counts.get(day, 0) > info['rows']):
+            missing.append(day)
+    tasks = [(config, day, segments[day], low) for day in missing]
+
+    result = new_result()
+    pool = multiprocessing.Pool(jobs) if jobs > 1 and tasks else None
+    try:
+        # Days are analyzed in parallel, and merged in order as they
+        # are done.
+        computed = (pool.imap(analyze_day, tasks) if pool is not None
+                    else map(analyze_day, tasks))
+        for day in days:
+            path = os.path.join(directory, day + '.pickle')
+            if day in missing:
+                partial = next(computed)
+                if day < today:
+                    save_snapshot(path, partial, {
+                        'version': SNAPSHOT_VERSION, 'day': day,
+                        'rows': counts.get(day, 0)})
+            else:
+                partial = load_snapshot(path)
+
+            for name, part in partial.items():
+                if parts is None or name in parts:
+                    merge(result[name], part)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return result, len(missing)
+
+
 if __name__ == '__main__':
-    import sys
-    import pickle
+    import argparse
+
+    # Result files refer to the classes of the nodes by module, use the
+    # ones from the analyze module so other programs can load them.
+    from analyze import (load_result, post_analyze, prepare, prepare_days,
+                         render_pages, save_result)
+
+    def day(text):
+        # Padded, so days order the same as their strings.
+        return datetime.datetime.strptime(text, '%Y-%m-%d').strftime(
+            '%Y-%m-%d')
+
+    parser = argparse.ArgumentParser()
+    operations = parser.add_subparsers(dest='operation', metavar='operation')
+
+    prepare_parser = operations.add_parser(
+        'prepare', help="analyze the logged messages into a file")
+    prepare_parser.add_argument('file')
+    prepare_parser.add_argument('where', nargs='*', metavar='WHERE clause',
+                                help="only analyze messages matching this")
+    prepare_parser.add_argument('-p', '--partition', action='append',
+                                help="only analyze messages in this "
+                                     "partition, can be given more than once")
+    prepare_parser.add_argument('-j', '--jobs', type=int, default=1,
+                                help="number of processes to analyze with")
+    prepare_parser.add_argument('-i', '--incremental', action='store_true',
+                                help="only analyze messages added since the "
+                                     "file was last prepared")
+    prepare_parser.add_argument('-a', '--archive', metavar='DIR',
+                                help="also analyze the messages archived to "
+                                     "this directory")
+    prepare_parser.add_argument('--from', dest='first', metavar='DAY',
+                                type=day,
+                                help="analyze the messages logged from this "
+                                     "day, given as YYYY-MM-DD in UTC, using "
+                                     "daily snapshots")
+    prepare_parser.add_argument('--to', dest='last', metavar='DAY', type=day,
+                                help="last day to analyze with --from, "
+                                     "today by default")
+    prepare_parser.add_argument('-s', '--snapshots', metavar='DIR',
+                                default='snapshots',
+                                help="directory the daily snapshots are kept "
+                                     "in, by default snapshots")
+
+    render_parser = operations.add_parser(
+        'render', help="output the analysis in a file as HTML")
+    render_parser.add_argument('file')
+    render_parser.add_argument('-d', '--directory',
+                               help="write a page for each partition and an "
+                                    "index page to this directory, only "
+                                    "writing the pages that changed")
 
-    if len(sys.argv) < 3:
-        print("Usage: {0} prepare {{file}} [WHERE clause] \n"
-              "  or:  {0} render {{file}}".format(sys.argv[0]))
+    args = parser.parse_args()
 
-    elif sys.argv[1] == 'prepare':
-        result_file = open(sys.argv[2], 'wb')
-        config = eval(open('config.py').read())
+    if args.operation == 'prepare':
+        if args.last is not None and args.first is None:
+            parser.error("--to is only used with --from")
+        if args.first is not None:
+            args.last = args.last or datetime.datetime.utcnow().strftime(
+                '%Y-%m-%d')
+            if args.first > args.last:
+                parser.error("--from is after --to")
+
+        config = load_config()
         logging.basicConfig(level=logging.INFO)
-        connection = pymysql.connect(host=config['db_host'],
-                                     user=config['db_user'],
-                                     password=config['db_password'],
-                                     db=config['db_schema'],
-                                     charset='utf8mb4',
-                                     cursorclass=pymysql.cursors.DictCursor)
-
-        where = ' '.join(sys.argv[3:]) if len(sys.argv) > 3 else 'TRUE'
-        sql = "SELECT id, dir, raw FROM message WHERE {}".format(where)
-        result = defaultdict_factory()
-
-        with connection.cursor() as cursor:
-            cursor.execute(sql)
-
-            while True:
-                row = cursor.fetchone()
-                if row is None:
-                    break
-                analyze(row, result)
+        if args.where and args.archive:
+            print("A WHERE clause can't be applied to archived messages, "
+                  "use --partition instead")
+            exit(1)
 
-        pickle.dump(result, result_file)
-        result_file.close()
+        if args.first is not None and (args.where or args.incremental):
+            print("A range of days can't be prepared with a WHERE clause "
+                  "or incrementally")
+            exit(1)
 
-    elif sys.argv[1] == 'render':
-        result_file = open(sys.argv[2], 'rb')
-        result = pickle.load(result_file)
-        result_file.close()
-        post_analyze(result)
+        archive = Archive(args.archive) if args.archive else None
+        parts = set(args.partition) if args.partition else None
+        if args.first is not None:
+            result, analyzed = prepare_days(config, args.first, args.last,
+                                            args.snapshots, args.jobs,
+                                            archive, parts)
+            save_result(args.file, result, {'from': args.first,
+                                            'to': args.last,
+                                            'partitions': args.partition})
+            print("Analyzed {} days, the rest from snapshots".format(analyzed),
+                  file=sys.stderr)
+
+        else:
+            where = ' '.join(args.where) if args.where else 'TRUE'
+            if args.partition:
+                # The stored partition is indexed together with the id,
+                # so only the rows of the partitions are read.
+                escape = pymysql.converters.escape_string
+                names = ', '.join("'{}'".format(escape(p))
+                                  for p in args.partition)
+                where = '({}) AND part IN ({})'.format(where, names)
+
+            result, watermark = None, 0
+            if args.incremental and os.path.exists(args.file):
+                result, info = load_result(args.file)
+                if 'watermark' not in info:
+                    print("{} has no watermark, it can't be updated "
+                          "incrementally".format(args.file))
+                    exit(1)
+                if info['where'] != where:
+                    print("{} was prepared with WHERE clause {}"
+                          "".format(args.file, info['where']))
+                    exit(1)
+                if info.get('hash_version') != HASH_VERSION:
+                    print("{} was prepared by an older version, it can't be "
+                          "updated incrementally".format(args.file))
+                    exit(1)
+                watermark = info['watermark']
+
+            result, watermark = prepare(config, where, args.jobs, result,
+                                        watermark, archive, parts)
+            save_result(args.file, result, {'watermark': watermark,
+                                            'where': where,
+                                            'hash_version': HASH_VERSION})
+
+    elif args.operation == 'render':
+        result, info = load_result(args.file)
+        if args.directory is not None:
+            written, skipped = render_pages(result, args.directory)
+            print("Wrote {} pages, {} unchanged".format(written, skipped),
+                  file=sys.stderr)
+        else:
+            post_analyze(result)
 
     else:
-        print("Uknown operation {}".format(sys.argv[1]))
+        parser.print_usage()
         exit(1)
@@ -0,0 +1,262 @@
+"""Archival of old messages from the database to compressed files.
+
+Rows older than a number of days are moved, in id order, to gzip
+compressed JSON lines segment files, one for each day the rows were
+logged.  Rows journaled during an outage get ids after rows that were
+logged later, and end up in a later segment for their day.  Each line
+is a list of the id, time, dir, op, s, t, part, size, raw JSON text and
+session of a row, segments archived by older versions lack the session.
+
+An index file lists the segments with the id and time ranges of their
+rows, and the highest id archived.  Segments are written and synced
+before they are added to the index, and rows are only deleted from the
+database once the index has been saved, so an archival that is
+interrupted can be run again.
+
+Archived rows hold the text of the payloads they referred to, so once
+they are deleted, payloads no other message refers to are deleted too.
+The writer only trusts that a payload is stored for a day after it was
+last referred to, see writer.DEDUP_MAX_AGE, so archive_after_days has
+to be more than a day.
+"""
+
+import datetime
+import gzip
+import json
+import logging
+import os
+import sys
+
+from codec import RAW_SQL, Codec, load_dictionaries
+
+
+INDEX_NAME = 'index.json'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Hash of the payload a message refers to, or NULL.
+PAYLOAD_HASH_SQL = ("IF(LEFT(message.raw, 1) = 0x01, "
+                    "SUBSTRING(message.raw, 2), NULL)")
+
+
+class Archive:
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(os.path.join(path, INDEX_NAME)) as index_file:
+                index = json.load(index_file)
+        except FileNotFoundError:
+            index = {'last_id': 0, 'segments': []}
+        self.last_id = index['last_id']
+        self.segments = index['segments']
+
+    def save(self):
+        path = os.path.join(self.path, INDEX_NAME)
+        with open(path + '.tmp', 'w') as index_file:
+            json.dump({'last_id': self.last_id, 'segments': self.segments},
+                      index_file, indent=1)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(path + '.tmp', path)
+
+    def clean(self):
+        """Remove segments left behind by an interrupted archival."""
+        os.makedirs(self.path, exist_ok=True)
+        known = {s['file'] for s in self.segments}
+        for name in os.listdir(self.path):
+            if name.endswith(('.jsonl.gz', '.jsonl.gz.tmp')) and name not in known:
+                logging.info("Removing unindexed segment %s", name)
+                os.remove(os.path.join(self.path, name))
+
+    def open(self, day, first_id):
+        """Start a new segment of rows logged on day."""
+        return Segment(self, day, first_id)
+
+    def segments_after(self, low):
+        """Paths of the segments with rows with an id above low."""
+        return [os.path.join(self.path, s['file'])
+                for s in self.segments if s['last_id'] > low]
+
+    def read(self, low=0):
+        """Generate the archived rows with an id above low in id order."""
+        for path in self.segments_after(low):
+            yield from read_segment(path, low)
+
+
+class Segment:
+    """Segment being written, rows are written to it as they are added
+    and it's added to the index of the archive by finish.
+    """
+
+    def __init__(self, archive, day, first_id):
+        self.archive = archive
+        self.day = day
+        self.name = '{}-{:010d}.jsonl.gz'.format(day, first_id)
+        self.path = os.path.join(archive.path, self.name)
+        self.rows = 0
+        self.first_id = first_id
+        self.last_id = None
+        self.first_time = self.last_time = None
+        self.file = open(self.path + '.tmp', 'wb')
+        self.segment = gzip.GzipFile(fileobj=self.file, mode='wb')
+
+    def add(self, row):
+        self.segment.write(json.dumps(row).encode('utf-8'))
+        self.segment.write(b'\n')
+        self.rows += 1
+        self.last_id = row[0]
+        if self.first_time is None or row[1] < self.first_time:
+            self.first_time = row[1]
+        if self.last_time is None or row[1] > self.last_time:
+            self.last_time = row[1]
+
+    def finish(self):
+        self.segment.close()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+        archive = self.archive
+        archive.segments.append({
+            'file': self.name, 'day': self.day, 'rows': self.rows,
+            'first_id': self.first_id, 'last_id': self.last_id,
+            'first_time': self.first_time, 'last_time': self.last_time,
+        })
+        archive.last_id = self.last_id
+        archive.save()
+
+
+def read_segment(path, low=0):
+    with gzip.open(path, 'rt', encoding='utf-8') as segment:
+        for line in segment:
+            row = json.loads(line)
+            if row[0] > low:
+                yield row
+
+
+def archive_rows(connection, target, days, chunk_size=10000):
+    """Move the rows logged more than days days ago to target."""
+    codec = Codec(load_dictionaries(connection))
+    target.clean()
+    # Rows may be left over if the last archival was interrupted.
+    delete_archived(connection, target.last_id, chunk_size)
+
+    today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0,
+                                               microsecond=0)
+    cutoff = today - datetime.timedelta(days=days)
+
+    # Rows are written to the segment of their day as they are read, so
+    # only a chunk of rows is held at a time.
+    last = target.last_id
+    segment = None
+    # Size of the payloads referred to by archived rows, by hash.
+    payloads = {}
+    done = False
+    while not done:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id, time, dir, op, s, t, part, size, {}, "
+                           "session, {} FROM message WHERE id > %s "
+                           "ORDER BY id LIMIT %s"
+                           "".format(RAW_SQL, PAYLOAD_HASH_SQL),
+                           (last, chunk_size))
+            chunk = cursor.fetchall()
+        if not chunk:
+            break
+
+        for (i, logged, direction, op, s, t, part, size, raw, session,
+                digest) in chunk:
+            # Rows are archived in id order, up to the first that is too
+            # new, so everything below the last archived id is archived.
+            if logged >= cutoff:
+                done = True
+                break
+
+            day = logged.strftime('%Y-%m-%d')
+            if segment is not None and segment.day != day:
+                store(connection, segment, chunk_size)
+                segment = None
+            if segment is None:
+                segment = target.open(day, i)
+            segment.add((i, logged.strftime(TIME_FORMAT), direction, op, s,
+                         t, part, size, codec.decode(raw), session))
+            if digest is not None:
+                payloads[bytes(digest)] = size
+            last = i
+
+    if segment is not None:
+        store(connection, segment, chunk_size)
+
+    if payloads:
+        deleted = delete_payloads(connection, payloads, target.last_id,
+                                  chunk_size)
+        print("Deleted {} of {} payloads of archived rows"
+              "".format(deleted, len(payloads)), file=sys.stderr)
+
+def store(connection, segment, chunk_size):
+    segment.finish()
+    delete_archived(connection, segment.last_id, chunk_size)
+    print("Archived {} rows logged on {}, up to id {}"
+          "".format(segment.rows, segment.day, segment.last_id),
+          file=sys.stderr)
+
+def delete_archived(connection, last_id, chunk_size):
+    for table in ('message', 'keyindex'):
+        while True:
+            with connection.cursor() as cursor:
+                deleted = cursor.execute("DELETE FROM {} WHERE id <= %s "
+                                         "ORDER BY id LIMIT %s".format(table),
+                                         (last_id, chunk_size))
+            connection.commit()
+            if deleted < chunk_size:
+                break
+
+def delete_payloads(connection, payloads, last_id, chunk_size):
+    """Delete the payloads no message refers to, given as a dict of
+    their size by hash, after the messages up to last_id were deleted.
+    """
+    # Messages referring to a payload have the size of its text, which
+    # saves reading the raw of most rows.
+    sizes = sorted(set(payloads.values()))
+    unused = dict(payloads)
+    after = last_id
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MAX(id) FROM message")
+        high = cursor.fetchone()[0] or 0
+    while unused and after < high:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id, SUBSTRING(raw, 2) FROM message "
+                           "WHERE id > %s AND id <= %s AND size IN %s "
+                           "AND LEFT(raw, 1) = 0x01 ORDER BY id LIMIT %s",
+                           (after, high, sizes, chunk_size))
+            rows = cursor.fetchall()
+        connection.commit()
+        for i, digest in rows:
+            unused.pop(bytes(digest), None)
+        if len(rows) < chunk_size:
+            break
+        after = rows[-1][0]
+
+    # Messages logged since the scan are checked again as the payloads
+    # are deleted.  The check locks the rows it reads, so it waits for
+    # a writer that has stored a payload again but not committed yet.
+    hashes = sorted(unused)
+    deleted = 0
+    for i in range(0, len(hashes), chunk_size):
+        with connection.cursor() as cursor:
+            deleted += cursor.execute(
+                "DELETE FROM payload WHERE hash IN %s AND NOT EXISTS "
+                "(SELECT 1 FROM message WHERE message.id > %s AND "
+                "message.raw = CONCAT(0x01, payload.hash))",
+                (hashes[i:i + chunk_size], high))
+        connection.commit()
+    return deleted
+
+
+if __name__ == '__main__':
+    from database import connect, load_config
+
+    config = load_config()
+    logging.basicConfig(level=logging.INFO)
+    connection = connect(config)
+    archive_rows(connection, Archive(config.get('archive_dir', 'archive')),
+                 config.get('archive_after_days', 90))
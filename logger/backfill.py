@@ -0,0 +1,60 @@
+"""Fill in the partition and size of rows logged by older versions.
+
+Rows are converted in chunks in id order, so the backfill can be
+interrupted and restarted.  Rows logged before the size column existed
+have it NULL, which is how rows left to do are found.
+"""
+
+import json
+import sys
+
+from codec import RAW_SQL, Codec, load_dictionaries
+from writer import message_partition
+
+
+def backfill(connection, chunk_size):
+    codec = Codec(load_dictionaries(connection))
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MAX(id) FROM message")
+        high = cursor.fetchone()[0] or 0
+
+    last = 0
+    updated = 0
+    while last < high:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id, dir, {} FROM message "
+                           "WHERE id > %s AND size IS NULL "
+                           "ORDER BY id LIMIT %s".format(RAW_SQL),
+                           (last, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for i, direction, raw in rows:
+                raw = codec.decode(raw)
+                try:
+                    part = message_partition(direction, json.loads(raw))
+                except ValueError:
+                    part = None
+                updates.append((part, len(raw.encode('utf-8')), i))
+
+            cursor.executemany("UPDATE message SET part = %s, size = %s "
+                               "WHERE id = %s", updates)
+        connection.commit()
+
+        last = rows[-1][0]
+        updated += len(updates)
+        print("Updated {} rows, at id {} of {}".format(updated, last, high),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    import logging
+
+    from database import connect, load_config
+
+    config = load_config()
+    logging.basicConfig(level=logging.INFO)
+    connection = connect(config)
+    backfill(connection, int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,466 @@
+"""Microbenchmarks for the logger.
+
+The suite benchmark times each stage a message goes through, from
+redaction in the bot to the rendered analysis, on frames made by a
+deterministic generator.  Its results are written as JSON, so the
+results of two runs can be compared.
+"""
+
+import collections
+import io
+import json
+import pickle
+import platform
+import random
+import time
+import timeit
+import tracemalloc
+
+from analyze import (add_value, analyze, flatten_prop, merge_result,
+                     new_result, partition, post_analyze, sub_analyze)
+from redact import redact
+from writer import make_row
+
+
+def legacy_redact(raw):
+    # The redaction log_msg used to do, kept for comparison.
+    backlog = [('', json.loads(raw))]
+    while len(backlog):
+        n, e = backlog.pop()
+        if type(e) == dict:
+            backlog.extend([(k, v) for k, v in e.items()])
+        elif type(e) == list:
+            backlog.extend([('', v) for v in e])
+        elif n in ('session_id', 'token'):
+            raw = raw.replace(e, '[REDACTED]')
+
+    return raw, json.loads(raw)
+
+def current_redact(raw):
+    raw = redact(raw)
+    return raw, json.loads(raw)
+
+def load_frames(path):
+    with open(path, encoding='utf-8') as frames_file:
+        return [line.rstrip('\n') for line in frames_file if line.strip()]
+
+def time_func(func, frames, repeat):
+    def run():
+        for raw in frames:
+            func(raw)
+    return min(timeit.repeat(run, number=1, repeat=repeat))
+
+def bench_redact(frames, repeat=5):
+    checked = []
+    for raw in frames:
+        try:
+            expected = legacy_redact(raw)[0]
+        except TypeError:
+            # The old code failed on non-string values for these keys.
+            continue
+        if current_redact(raw)[0] != expected:
+            raise ValueError("redaction differs for frame {!r:.80}".format(raw))
+        checked.append(raw)
+
+    size = sum(len(raw) for raw in checked)
+    print("{} frames, {} bytes, output identical".format(len(checked), size))
+    for name, func in (('legacy', legacy_redact), ('current', current_redact)):
+        elapsed = time_func(func, checked, repeat)
+        print("{:8} {:10.3f} ms {:10.1f} MB/s"
+              "".format(name, elapsed * 1000, size / elapsed / 1e6))
+
+def legacy_tree():
+    return collections.defaultdict(legacy_tree)
+
+def legacy_sub_analyze(node, leaf, snoflake=False):
+    # The nested dict nodes analyze.py used to build, kept for comparison.
+    node['count'] = node.get('count', 0) + 1
+
+    t = type(leaf).__name__
+    node['types'][t] = node['types'].get(t, 0) + 1
+
+    if t == 'dict':
+        for k, v in leaf.items():
+            legacy_sub_analyze(node['nodes'][k], v, k=='guilds')
+    elif t == 'list':
+        for v in leaf:
+            node['leaf_count'] = node.get('leaf_count', 0) + 1
+            if snoflake and v.get('unavailable'):
+                legacy_sub_analyze(node['snowflake_leafs'], v)
+            else:
+                legacy_sub_analyze(node['leafs'], v)
+    else:
+        values = node['values']
+        if t == 'str':
+            if 'charset' in node:
+                node['charset'].update(list(leaf))
+            elif len(values) > 10:
+                node['charset'] = set(list(leaf))
+                for k in list(values.keys()):
+                    if type(k) == str:
+                        node['charset'].update(list(k))
+            else:
+                values[leaf] = values.get(leaf, 0) + 1
+        elif t == 'int':
+            if 'min' in node:
+                node['min'] = min(node['min'], leaf)
+                node['max'] = max(node['max'], leaf)
+            elif len(values) > 10:
+                ints = [v for v in values if type(v) == int]
+                ints.append(leaf)
+                node['min'] = min(ints)
+                node['max'] = max(ints)
+            else:
+                values[leaf] = values.get(leaf, 0) + 1
+        else:
+            values[leaf] = values.get(leaf, 0) + 1
+
+def nodes_sub_analyze(node, leaf, snoflake=False):
+    # sub_analyze without the value statistics, which the legacy tree
+    # doesn't have either.
+    node.count += 1
+
+    t = type(leaf).__name__
+    types = node.types
+    types[t] = types.get(t, 0) + 1
+
+    if t == 'dict':
+        for k, v in leaf.items():
+            nodes_sub_analyze(node.child(k), v, k=='guilds')
+    elif t == 'list':
+        for v in leaf:
+            node.leaf_count += 1
+            nodes_sub_analyze(node.leaf(snoflake and v.get('unavailable')),
+                              v)
+    else:
+        add_value(node, t, leaf, stats=False)
+
+def build_tree(factory, analyze_func, messages):
+    result = factory()
+    for data in messages:
+        analyze_func(result[partition(0, data)], data)
+    return result
+
+def bench_tree(frames, repeat=5):
+    messages = [json.loads(raw) for raw in frames]
+    print("{} frames".format(len(messages)))
+    print("{:8} {:>10} {:>12} {:>12}"
+          "".format('', 'time', 'memory', 'pickle'))
+    for name, factory, func in (('legacy', legacy_tree, legacy_sub_analyze),
+                                ('nodes', new_result, nodes_sub_analyze),
+                                ('current', new_result, sub_analyze)):
+        elapsed = min(timeit.repeat(
+            lambda: build_tree(factory, func, messages),
+            number=1, repeat=repeat))
+
+        tracemalloc.start()
+        result = build_tree(factory, func, messages)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        size = len(pickle.dumps(result))
+        print("{:8} {:7.1f} ms {:9.0f} kB {:9.0f} kB"
+              "".format(name, elapsed * 1000, memory / 1e3, size / 1e3))
+    # The statistics make current slower and larger than legacy, which
+    # is compared against nodes.
+    print("legacy keeps the first values and the characters and range "
+          "of the rest,\nnodes the current tree without value "
+          "statistics, and current adds distinct\ncounts, samples, "
+          "string lengths and int ranges.")
+
+class FrameGenerator:
+    """Makes gateway frames shaped like those Discord sends."""
+
+    def __init__(self, seed=0, guilds=100, members=250):
+        self.random = random.Random(seed)
+        self.guild_count = guilds
+        self.member_count = members
+        self.seq = 0
+
+    def snowflake(self):
+        return str(self.random.randrange(10**17, 10**18))
+
+    def timestamp(self):
+        return '2016-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}.{:06d}+00:00'.format(
+            self.random.randrange(1, 13), self.random.randrange(1, 29),
+            self.random.randrange(24), self.random.randrange(60),
+            self.random.randrange(60), self.random.randrange(10**6))
+
+    def text(self, low, high):
+        words = self.random.randrange(low, high)
+        return ' '.join(self.random.choice(WORDS) for i in range(words))
+
+    def user(self):
+        r = self.random
+        return {'id': self.snowflake(),
+                'username': self.text(1, 3),
+                'discriminator': '{:04d}'.format(r.randrange(10000)),
+                'avatar': r.choice([None, '{:032x}'.format(r.getrandbits(128))])}
+
+    def role(self, position):
+        r = self.random
+        return {'id': self.snowflake(), 'name': self.text(1, 3),
+                'color': r.choice([0, r.randrange(1 << 24)]),
+                'hoist': r.random() < 0.2, 'managed': False,
+                'position': position, 'permissions': r.randrange(1 << 31)}
+
+    def channel(self, position):
+        r = self.random
+        channel_type = r.choice(['text', 'text', 'voice'])
+        channel = {'id': self.snowflake(), 'name': self.text(1, 2),
+                   'type': channel_type, 'position': position,
+                   'permission_overwrites': [
+                       {'id': self.snowflake(), 'type': 'role',
+                        'allow': r.randrange(1 << 20), 'deny': 0}
+                       for i in range(r.randrange(3))]}
+        if channel_type == 'text':
+            channel['topic'] = r.choice([None, self.text(2, 12)])
+            channel['last_message_id'] = self.snowflake()
+        else:
+            channel['bitrate'] = r.choice([64000, 96000])
+        return channel
+
+    def presence(self):
+        presence = {'user': {'id': self.snowflake()},
+                    'status': self.random.choice(['online', 'idle', 'offline'])}
+        # The report can't show a property that is both null and an
+        # object, so game is left out instead of being null.
+        if self.random.random() < 0.3:
+            presence['game'] = {'name': self.text(1, 4)}
+        return presence
+
+    def member(self):
+        r = self.random
+        return {'user': self.user(), 'joined_at': self.timestamp(),
+                'roles': [self.snowflake() for i in range(r.randrange(3))],
+                'deaf': False, 'mute': r.random() < 0.01}
+
+    def guild(self, members):
+        r = self.random
+        return {'id': self.snowflake(), 'name': self.text(1, 4),
+                'icon': r.choice([None, '{:032x}'.format(r.getrandbits(128))]),
+                'owner_id': self.snowflake(), 'region': r.choice(REGIONS),
+                'afk_channel_id': None, 'afk_timeout': 300,
+                'joined_at': self.timestamp(), 'large': members > 250,
+                'member_count': members,
+                'roles': [self.role(i) for i in range(r.randrange(1, 15))],
+                'channels': [self.channel(i) for i in range(r.randrange(1, 20))],
+                'members': [self.member() for i in range(members)],
+                'presences': [self.presence()
+                              for i in range(r.randrange(members // 2 + 1))],
+                'voice_states': [], 'emojis': [], 'features': []}
+
+    def dispatch(self, t, d):
+        self.seq += 1
+        return {'op': 0, 's': self.seq, 't': t, 'd': d}
+
+    def ready(self):
+        guilds = []
+        for i in range(self.guild_count):
+            if self.random.random() < 0.1:
+                guilds.append({'id': self.snowflake(), 'unavailable': True})
+            else:
+                guilds.append(self.guild(self.random.randrange(1, 50)))
+        return self.dispatch('READY', {
+            'v': 3, 'user': self.user(),
+            'session_id': '{:032x}'.format(self.random.getrandbits(128)),
+            'heartbeat_interval': 41250, 'guilds': guilds,
+            'private_channels': [{'id': self.snowflake(), 'is_private': True,
+                                  'recipient': self.user(),
+                                  'last_message_id': self.snowflake()}
+                                 for i in range(self.random.randrange(10))],
+            'read_state': [], 'user_settings': {}})
+
+    def guild_create(self):
+        members = self.random.randrange(self.member_count // 2,
+                                        self.member_count * 2)
+        return self.dispatch('GUILD_CREATE', self.guild(members))
+
+    def message_create(self):
+        r = self.random
+        return self.dispatch('MESSAGE_CREATE', {
+            'id': self.snowflake(), 'channel_id': self.snowflake(),
+            'author': self.user(), 'content': self.text(1, 40),
+            'timestamp': self.timestamp(), 'edited_timestamp': None,
+            'tts': False, 'mention_everyone': r.random() < 0.01,
+            'mentions': [self.user() for i in range(r.choice([0, 0, 0, 1, 2]))],
+            'attachments': [], 'embeds': [], 'nonce': self.snowflake()})
+
+    def presence_update(self):
+        presence = self.presence()
+        presence['guild_id'] = self.snowflake()
+        presence['roles'] = [self.snowflake()
+                             for i in range(self.random.randrange(3))]
+        return self.dispatch('PRESENCE_UPDATE', presence)
+
+    def op_only(self):
+        op = self.random.choice([1, 7, 9])
+        if op == 1:
+            return {'op': 1, 'd': self.seq}
+        elif op == 7:
+            return {'op': 7, 'd': {'url': 'wss://gateway.discord.gg'}}
+        else:
+            return {'op': 9, 'd': None}
+
+    def frames(self, count):
+        """Generate count raw frames, starting with a READY."""
+        kinds = [(self.guild_create, 0.01), (self.message_create, 0.45),
+                 (self.presence_update, 0.44), (self.op_only, 0.10)]
+        yield json.dumps(self.ready())
+        for i in range(count - 1):
+            pick = self.random.random()
+            for make, weight in kinds:
+                pick -= weight
+                if pick < 0:
+                    break
+            yield json.dumps(make())
+
+WORDS = ('the', 'discord', 'bot', 'log', 'message', 'gateway', 'ping', 'lol',
+         'server', 'channel', 'role', 'voice', 'hello', 'world', 'api', 'is',
+         'a', 'test', 'of', 'some', 'thing', 'with', '\u00e9t\u00e9', '\u2764',
+         'https://example.com/x', '@everyone', '<@80351110224678912>')
+REGIONS = ('us-west', 'us-east', 'us-central', 'london', 'amsterdam',
+           'frankfurt', 'singapore', 'sydney')
+
+
+def time_stage(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def run_suite(frames, repeat=5, jobs=4):
+    """Time each stage, returns a dict of seconds and items per stage."""
+    stages = collections.OrderedDict()
+    rows = [(i, 0, raw) for i, raw in enumerate(frames, 1)]
+
+    def redact_stage():
+        for raw in frames:
+            redact(raw)
+    stages['redact'] = (time_stage(redact_stage, repeat), len(frames))
+
+    def ingest_stage():
+        # The work log_msg does for each message.
+        for raw in frames:
+            raw = redact(raw)
+            make_row(False, raw, json.loads(raw))
+    stages['ingest'] = (time_stage(ingest_stage, repeat), len(frames))
+
+    def analyze_stage():
+        result = new_result()
+        for row in rows:
+            analyze(row, result)
+        return result
+    stages['analyze'] = (time_stage(analyze_stage, repeat), len(rows))
+    result = analyze_stage()
+
+    partials = []
+    for i in range(jobs):
+        partial = new_result()
+        for row in rows[i * len(rows) // jobs:(i + 1) * len(rows) // jobs]:
+            analyze(row, partial, True)
+        partials.append(pickle.loads(pickle.dumps(partial)))
+
+    def merge_stage():
+        merged = new_result()
+        for partial in partials:
+            merge_result(merged, partial)
+    stages['merge'] = (time_stage(merge_stage, repeat), len(rows))
+
+    def flatten_stage():
+        return [list(flatten_prop(part, part.count))
+                for part in result.values()]
+    lines = sum(len(l) for l in flatten_stage())
+    stages['flatten'] = (time_stage(flatten_stage, repeat), lines)
+
+    def render_stage():
+        post_analyze(result, io.StringIO())
+    stages['render'] = (time_stage(render_stage, repeat), lines)
+
+    return stages
+
+def bench_suite(args):
+    frames = list(FrameGenerator(args.seed).frames(args.frames))
+    stages = run_suite(frames, args.repeat)
+
+    results = {
+        'frames': len(frames),
+        'bytes': sum(len(raw) for raw in frames),
+        'seed': args.seed,
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'stages': collections.OrderedDict(
+            (name, {'seconds': seconds, 'items': items,
+                    'us_per_item': seconds / items * 1e6})
+            for name, (seconds, items) in stages.items()),
+    }
+
+    print("{} frames, {} bytes".format(results['frames'], results['bytes']))
+    for name, stage in results['stages'].items():
+        print("{:8} {:10.1f} ms {:10.2f} us/item"
+              "".format(name, stage['seconds'] * 1000, stage['us_per_item']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+            output_file.write('\n')
+
+def bench_compare(args):
+    with open(args.old) as old_file, open(args.new) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+
+    if old['frames'] != new['frames'] or old['seed'] != new['seed']:
+        print("Warning: runs used different frames")
+    print("{:8} {:>12} {:>12} {:>8}".format('', 'old', 'new', 'change'))
+    for name, stage in new['stages'].items():
+        if name not in old['stages']:
+            continue
+        before = old['stages'][name]['us_per_item']
+        after = stage['us_per_item']
+        print("{:8} {:9.2f} us {:9.2f} us {:+7.1f}%"
+              "".format(name, before, after, (after / before - 1) * 100))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    benchmarks = parser.add_subparsers(dest='benchmark', metavar='benchmark')
+
+    frames_help = ("file with one raw message per line, for example from: "
+                   "mysql --batch --raw --skip-column-names "
+                   "-e 'SELECT raw FROM message'")
+    redact_parser = benchmarks.add_parser(
+        'redact', help="compare redaction with the old implementation")
+    redact_parser.add_argument('frames', help=frames_help)
+    tree_parser = benchmarks.add_parser(
+        'tree', help="compare analysis nodes with the old implementation")
+    tree_parser.add_argument('frames', help=frames_help)
+
+    suite_parser = benchmarks.add_parser(
+        'suite', help="time each stage on generated frames")
+    suite_parser.add_argument('-n', '--frames', type=int, default=2000,
+                              help="number of frames to generate")
+    suite_parser.add_argument('-s', '--seed', type=int, default=0,
+                              help="seed of the frame generator")
+    suite_parser.add_argument('-r', '--repeat', type=int, default=5,
+                              help="times to run each stage, the fastest "
+                                   "run is reported")
+    suite_parser.add_argument('-o', '--output',
+                              help="write the results to this file as JSON")
+
+    compare_parser = benchmarks.add_parser(
+        'compare', help="compare the JSON results of two suite runs")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'redact':
+        bench_redact(load_frames(args.frames))
+    elif args.benchmark == 'tree':
+        bench_tree(load_frames(args.frames))
+    elif args.benchmark == 'suite':
+        bench_suite(args)
+    elif args.benchmark == 'compare':
+        bench_compare(args)
+    else:
+        parser.print_usage()
+        exit(1)
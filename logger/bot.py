@@ -1,8 +1,21 @@
 import json
 import logging
+import threading
+import time
 
 from discord import Client, utils
-import pymysql
+
+from codec import load_codec
+from commands import CommandWorker, TokenBucket
+from database import connect, load_config
+from journal import Journal
+from metrics import Metrics, serve
+from redact import redact
+from writer import Writer, make_row
+
+
+# Seconds a member's role is remembered for.
+ROLE_CACHE_TIME = 60
 
 
 def command(func):
@@ -11,14 +24,36 @@ def command(func):
 
 
 class LoggerBot(Client):
-    def __init__(self, config):
+    def __init__(self, config, writer, metrics, session=None, commands=True):
         Client.__init__(self)
         self.config = config
+        self.writer = writer
+        self.session = session
+        self.handle_commands = commands
+        self.worker = CommandWorker(self.handle_message,
+                                    config.get('command_queue_size', 100))
+        self.send_limit = TokenBucket(config.get('send_rate', 1.0),
+                                      config.get('send_burst', 5))
+        self.roles = {}
+        # Not self.metrics, which is the command.
+        self.ingest = metrics
         self.commands = []
         for k, v in LoggerBot.__dict__.items():
             if hasattr(v, 'command'):
                 self.commands.append(k)
 
+    def run(self):
+        self.worker.start()
+        try:
+            Client.run(self)
+        finally:
+            self.worker.close()
+
+    def send_message(self, destination, content):
+        # Only called from the command worker, which this holds up.
+        self.send_limit.acquire()
+        return Client.send_message(self, destination, content)
+
     def on_socket_raw_send(self, msg, binary):
         self.log_msg(True, msg)
 
@@ -26,45 +61,24 @@ class LoggerBot(Client):
         self.log_msg(False, msg)
 
     def log_msg(self, is_send, msg):
-        raw = str(msg)
-        dr = int(is_send)
-
-        backlog = [('', json.loads(raw))]
-        while len(backlog):
-            n, e = backlog.pop()
-            if type(e) == dict:
-                backlog.extend([(k, v) for k, v in e.items()])
-            elif type(e) == list:
-                backlog.extend([('', v) for v in e])
-            elif n in ('session_id', 'token'):
-                raw = raw.replace(e, '[REDACTED]')
-
-        m = json.loads(raw)
-        if 'op' in m and 'd' in m:
-
-            if 's' in m and 't' in m:
-                with connection.cursor() as cursor:
-                    sql = ("INSERT INTO message (dir, op, s, t, raw) "
-                           "VALUES (%s, %s, %s, %s, %s)")
-                    cursor.execute(sql, (dr, m['op'], m['s'], m['t'], raw))
-            elif 's' in m:
-                with connection.cursor() as cursor:
-                    sql = ("INSERT INTO message (dir, op, s, raw) "
-                           "VALUES (%s, %s, %s, %s)")
-                    cursor.execute(sql, (dr, m['op'], m['s'], raw))
-            else:
-                with connection.cursor() as cursor:
-                    sql = ("INSERT INTO message (dir, op, raw) "
-                           "VALUES (%s, %s, %s)")
-                    cursor.execute(sql, (dr, m['op'], raw))
-        else:
-            with connection.cursor() as cursor:
-                sql = ("INSERT INTO message (dir, raw) VALUES (%s, %s)")
-                cursor.execute(sql, (dr, raw))
-
-        connection.commit()
+        raw = redact(str(msg))
+        row = make_row(is_send, raw, json.loads(raw), self.session)
+        self.ingest.logged(row)
+        self.writer.put(row)
 
     def get_role(self, member):
+        now = time.monotonic()
+        cached = self.roles.get(member.id)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        if len(self.roles) > 10000:
+            self.roles.clear()
+        role = self.find_role(member)
+        self.roles[member.id] = (role, now + ROLE_CACHE_TIME)
+        return role
+
+    def find_role(self, member):
         if member.id in self.config['masters']:
             return 'master'
         elif member.id in self.config['admins']:
@@ -77,9 +91,12 @@ class LoggerBot(Client):
             return 'user'
 
     def on_message(self, msg):
+        if not self.handle_commands: return
         if msg.channel.is_private: return
         if not msg.content.startswith(self.config['trigger']): return
+        self.worker.put(msg)
 
+    def handle_message(self, msg):
         line = msg.content[len(self.config['trigger']):]
         if ' ' in line:
             cmd, arg = line.split(' ', 1)
@@ -136,6 +153,11 @@ class LoggerBot(Client):
             self.send_message(message.channel,
                               "Refusing to leave protected server")
 
+    @command
+    def metrics(self, message, argument):
+        """- Show how the logging of messages is keeping up."""
+        self.send_message(message.channel, self.ingest.summary())
+
     @command
     def help(self, message, argument):
         """- Show this help text."""
@@ -154,6 +176,8 @@ class LoggerBot(Client):
 
 
     def add_field(self, field, field_type, channel, argument):
+        # Roles depend on the fields changed here.
+        self.roles.clear()
         if argument is None:
             self.send_message(channel, "Error: missing argument")
 
@@ -204,6 +228,7 @@ class LoggerBot(Client):
                 self.send_message(channel, "Which one? {}.".format(names))
 
     def remove_field(self, field, field_type, channel, argument):
+        self.roles.clear()
         if argument is None:
             self.send_message(channel, "Error: missing argument")
 
@@ -322,6 +347,31 @@ class LoggerBot(Client):
                               '{} {}'.format(type(e).__name__, e))
 
 
+def config_sessions(config):
+    """The sessions to log, by default one for bot_user without a name.
+
+    Only the first session answers commands unless commands is set.
+    """
+    sessions = config.get('sessions')
+    if not sessions:
+        sessions = [{'name': None, 'bot_user': config['bot_user'],
+                     'bot_password': config['bot_password']}]
+    return [dict({'commands': i == 0}, **s) for i, s in enumerate(sessions)]
+
+def run_session(config, writer, metrics, session, retry_interval):
+    """Log a session, logging in again if it fails."""
+    while True:
+        bot = LoggerBot(config, writer, metrics, session['name'],
+                        session['commands'])
+        try:
+            bot.login(session['bot_user'], session['bot_password'])
+            bot.run()
+            return
+        except Exception:
+            logging.exception("Session %s failed, restarting in %s seconds",
+                              session['name'], retry_interval)
+        time.sleep(retry_interval)
+
 def write_config(config):
     config_file = open('config.py', 'w')
     lines = ['    {!r}: {!r},'.format(k, config[k]) for k in sorted(config)]
@@ -329,19 +379,42 @@ def write_config(config):
     config_file.close()
 
 if __name__ == '__main__':
-    global connection
-    config = eval(open('config.py').read())
+    config = load_config()
     logging.basicConfig(level=logging.INFO)
-    connection = pymysql.connect(host=config['db_host'],
-                                 user=config['db_user'],
-                                 password=config['db_password'],
-                                 db=config['db_schema'],
-                                 charset='utf8mb4',
-                                 cursorclass=pymysql.cursors.DictCursor)
-
-    bot = LoggerBot(config)
-    bot.login(config['bot_user'], config['bot_password'])
+    connection = connect(config, read_timeout=config.get('db_timeout', 30),
+                         write_timeout=config.get('db_timeout', 30))
+    codec = load_codec(connection) if config.get('compress_raw') else None
+
+    metrics = Metrics()
+    journal = Journal(config.get('journal_dir', 'journal'),
+                      config.get('journal_segment_rows', 1000))
+    writer = Writer(connection, journal, codec,
+                    config.get('write_batch_size', 100),
+                    config.get('write_flush_interval', 1.0),
+                    config.get('write_queue_size', 10000),
+                    config.get('write_retry_interval', 10.0),
+                    metrics, config.get('dedup_size'),
+                    config.get('dedup_cache', 10000))
+    metrics.gauge('logger_write_queue_depth', writer.queue.qsize)
+    metrics.gauge('logger_journal_segments', journal.count)
+    metrics.gauge('logger_spilling', lambda: int(writer.spilling))
+    writer.start()
+    if config.get('metrics_port') is not None:
+        serve(metrics, config['metrics_port'])
+
+    # All sessions share the writer and its database connection.
+    threads = []
+    for session in config_sessions(config):
+        threads.append(threading.Thread(
+            target=run_session, name='Session {}'.format(session['name']),
+            args=(config, writer, metrics, session,
+                  config.get('session_retry_interval', 30)),
+            daemon=True))
     try:
-        bot.run()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
     finally:
+        writer.close()
         write_config(config)
@@ -0,0 +1,199 @@
+"""Compressed storage of the raw column.
+
+A compressed value is a zero byte followed by a zlib stream.  JSON text
+never starts with a zero byte, so plain and compressed values can be
+told apart.  The stream may use a preset dictionary from the dictionary
+table, which is looked up by the dictionary id in the zlib header (the
+Adler-32 checksum of the dictionary).
+
+A value may also be a one byte followed by the SHA-256 hash of the JSON
+text, which refers to a value stored once in the payload table.  Queries
+select RAW_SQL instead of raw to get the value a reference refers to.
+"""
+
+import collections
+import hashlib
+import re
+import sys
+import zlib
+
+
+MARKER = b'\x00'
+REFERENCE = b'\x01'
+
+# The raw column of message with payload references resolved.
+RAW_SQL = ("IF(LEFT(message.raw, 1) = 0x01, (SELECT payload.raw FROM payload "
+           "WHERE payload.hash = SUBSTRING(message.raw, 2)), message.raw)")
+
+# Fragments of JSON text that are worth putting in a dictionary.
+_fragment = re.compile(r'"(?:[^"\\]|\\.){0,60}"\s*:?|[\[\]{},:]+|'
+                       r'-?\d+|true|false|null')
+
+
+class Codec:
+    def __init__(self, dictionaries=None, dictionary=None, level=6):
+        self.dictionaries = dictionaries if dictionaries is not None else {}
+        self.dictionary = dictionary
+        self.level = level
+
+    def encode(self, raw):
+        if self.dictionary is not None:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(self.level)
+        data = compressor.compress(raw.encode('utf-8')) + compressor.flush()
+        return MARKER + data
+
+    def decode(self, value):
+        if isinstance(value, str):
+            return value
+        if value[:1] == REFERENCE:
+            raise ValueError("Payload reference not resolved")
+        if value[:1] != MARKER:
+            return value.decode('utf-8')
+
+        if value[2] & 0x20:
+            dictionary_id = int.from_bytes(value[3:7], 'big')
+            decompressor = zlib.decompressobj(
+                zdict=self.dictionaries[dictionary_id])
+        else:
+            decompressor = zlib.decompressobj()
+        data = decompressor.decompress(value[1:]) + decompressor.flush()
+        return data.decode('utf-8')
+
+
+def is_compressed(value):
+    return not isinstance(value, str) and value[:1] == MARKER
+
+def is_reference(value):
+    return not isinstance(value, str) and value[:1] == REFERENCE
+
+def payload_hash(raw):
+    return hashlib.sha256(raw.encode('utf-8')).digest()
+
+def load_dictionaries(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT id, data FROM dictionary")
+        return {i: bytes(d) for i, d in cursor.fetchall()}
+
+def load_codec(connection, compress=True):
+    """Codec using the newest dictionary for compressing."""
+    dictionaries = load_dictionaries(connection)
+    if not compress:
+        return Codec(dictionaries)
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT id FROM dictionary "
+                       "ORDER BY created DESC, id LIMIT 1")
+        row = cursor.fetchone()
+    dictionary = dictionaries[row[0]] if row is not None else None
+    return Codec(dictionaries, dictionary)
+
+def train_dictionary(samples, size=32768):
+    """Build a preset dictionary from a list of raw JSON samples."""
+    counts = collections.Counter()
+    for raw in samples:
+        counts.update(_fragment.findall(raw))
+
+    # Each fragment saves roughly its length every time it is used.
+    scored = [(n * (len(f) - 3), f) for f, n in counts.items()
+              if n > 1 and len(f) > 3]
+    scored.sort(reverse=True)
+
+    chosen = []
+    used = 0
+    for score, fragment in scored:
+        length = len(fragment.encode('utf-8'))
+        if used + length > size:
+            continue
+        chosen.append(fragment)
+        used += length
+
+    # zlib finds matches near the end of the dictionary cheapest.
+    return ''.join(reversed(chosen)).encode('utf-8')
+
+def sample_rows(connection, count):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MIN(id), MAX(id) FROM message")
+        low, high = cursor.fetchone()
+        if low is None:
+            return []
+
+        step = max((high - low) // count, 1)
+        ids = list(range(low, high + 1, step))[:count]
+        cursor.execute("SELECT {} FROM message WHERE id IN %s"
+                       "".format(RAW_SQL), (ids,))
+        codec = Codec(load_dictionaries(connection))
+        return [codec.decode(r[0]) for r in cursor.fetchall()]
+
+def train(connection, count):
+    samples = sample_rows(connection, count)
+    if not samples:
+        print("No rows to train on")
+        return
+
+    dictionary = train_dictionary(samples)
+    dictionary_id = zlib.adler32(dictionary)
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO dictionary (id, data) VALUES (%s, %s)",
+                       (dictionary_id, dictionary))
+    connection.commit()
+
+    raw_size = sum(len(s.encode('utf-8')) for s in samples)
+    plain = sum(len(Codec().encode(s)) for s in samples)
+    trained = sum(len(Codec(dictionary=dictionary).encode(s))
+                  for s in samples)
+    print("Stored dictionary {} of {} bytes trained on {} rows"
+          "".format(dictionary_id, len(dictionary), len(samples)))
+    print("Sample size {} bytes, {} compressed, {} with dictionary"
+          "".format(raw_size, plain, trained))
+
+def migrate(connection, chunk_size):
+    codec = load_codec(connection)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MAX(id) FROM message")
+        high = cursor.fetchone()[0] or 0
+
+    last = 0
+    converted = 0
+    while last < high:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id, raw FROM message WHERE id > %s "
+                           "ORDER BY id LIMIT %s", (last, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            # References are left as they are, payloads are compressed
+            # when they are stored.
+            updates = [(codec.encode(codec.decode(raw)), i) for i, raw in rows
+                       if not is_compressed(raw) and not is_reference(raw)]
+            if updates:
+                cursor.executemany("UPDATE message SET raw = %s "
+                                   "WHERE id = %s", updates)
+        connection.commit()
+
+        last = rows[-1][0]
+        converted += len(updates)
+        print("Converted {} rows, at id {} of {}".format(converted, last, high),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    import logging
+
+    from database import connect, load_config
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('train', 'migrate'):
+        print("Usage: {0} train [sample rows]\n"
+              "  or:  {0} migrate [rows per chunk]".format(sys.argv[0]))
+        exit(1)
+
+    config = load_config()
+    logging.basicConfig(level=logging.INFO)
+    connection = connect(config)
+
+    if sys.argv[1] == 'train':
+        train(connection, int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    else:
+        migrate(connection, int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
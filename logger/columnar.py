@@ -0,0 +1,243 @@
+"""Export of the message metadata to column files for fast aggregation.
+
+Each column is a file of little endian fixed size values, one for each
+row in id order, which can be memory mapped as a NumPy array.  The t
+column holds indexes into the list of types in meta.json, where index 0
+is NULL, and NULL op and s values are stored as -1.  meta.json also
+holds the number of rows exported and the highest id, and is written
+after the columns, so values appended by an interrupted export are
+truncated away by the next one.
+"""
+
+import array
+import collections
+import datetime
+import json
+import os
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from archive import Archive
+
+
+# Name, array type code and NumPy type of the columns.
+COLUMNS = [
+    ('id', 'i', '<i4'),
+    ('time', 'i', '<i4'),
+    ('dir', 'b', '<i1'),
+    ('op', 'i', '<i4'),
+    ('s', 'i', '<i4'),
+    ('t', 'H', '<u2'),
+]
+
+META_NAME = 'meta.json'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def new_arrays():
+    return {name: array.array(code) for name, code, dtype in COLUMNS}
+
+
+class Columns:
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(os.path.join(path, META_NAME)) as meta_file:
+                meta = json.load(meta_file)
+        except FileNotFoundError:
+            meta = {'rows': 0, 'last_id': 0, 'types': [None]}
+        self.rows = meta['rows']
+        self.last_id = meta['last_id']
+        self.types = meta['types']
+        self.type_index = {t: i for i, t in enumerate(self.types)}
+
+    def column_path(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def save(self):
+        path = os.path.join(self.path, META_NAME)
+        with open(path + '.tmp', 'w') as meta_file:
+            json.dump({'rows': self.rows, 'last_id': self.last_id,
+                       'types': self.types}, meta_file)
+            meta_file.flush()
+            os.fsync(meta_file.fileno())
+        os.replace(path + '.tmp', path)
+
+    def truncate(self):
+        """Remove values not covered by meta.json."""
+        os.makedirs(self.path, exist_ok=True)
+        for name, code, dtype in COLUMNS:
+            with open(self.column_path(name), 'ab') as column_file:
+                column_file.truncate(self.rows * int(dtype[2:]))
+
+    def append(self, rows):
+        """Append (id, time, dir, op, s, t) rows, time in Unix time."""
+        arrays = new_arrays()
+        for i, logged, direction, op, s, t in rows:
+            if t not in self.type_index:
+                self.type_index[t] = len(self.types)
+                self.types.append(t)
+            arrays['id'].append(i)
+            arrays['time'].append(logged)
+            arrays['dir'].append(direction)
+            arrays['op'].append(-1 if op is None else op)
+            arrays['s'].append(-1 if s is None else s)
+            arrays['t'].append(self.type_index[t])
+
+        for name, values in arrays.items():
+            if sys.byteorder != 'little':
+                values.byteswap()
+            with open(self.column_path(name), 'ab') as column_file:
+                values.tofile(column_file)
+                column_file.flush()
+                os.fsync(column_file.fileno())
+
+        self.rows += len(rows)
+        self.last_id = rows[-1][0]
+        self.save()
+
+    def load(self):
+        """Return the columns as a dict of NumPy arrays, or lists."""
+        # The column files don't exist until something is exported.
+        if numpy is not None:
+            if not self.rows:
+                return {n: numpy.zeros(0, d) for n, c, d in COLUMNS}
+            return {name: numpy.memmap(self.column_path(name), dtype, 'r',
+                                       shape=(self.rows,))
+                    for name, code, dtype in COLUMNS}
+
+        columns = new_arrays()
+        if not self.rows:
+            return columns
+        for name, values in columns.items():
+            with open(self.column_path(name), 'rb') as column_file:
+                values.fromfile(column_file, self.rows)
+            if sys.byteorder != 'little':
+                values.byteswap()
+        return columns
+
+
+def export(connection, columns, archive=None, chunk_size=10000):
+    """Append the rows not yet in columns from the archive and table."""
+    columns.truncate()
+
+    if archive is not None:
+        rows = []
+        for row in archive.read(columns.last_id):
+            logged = datetime.datetime.strptime(row[1], TIME_FORMAT)
+            logged = logged.replace(tzinfo=datetime.timezone.utc)
+            rows.append((row[0], int(logged.timestamp())) + tuple(row[2:6]))
+            if len(rows) == chunk_size:
+                columns.append(rows)
+                rows = []
+        if rows:
+            columns.append(rows)
+
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id, UNIX_TIMESTAMP(time), dir, op, s, t "
+                           "FROM message WHERE id > %s ORDER BY id LIMIT %s",
+                           (columns.last_id, chunk_size))
+            rows = cursor.fetchall()
+        if not rows:
+            break
+        columns.append([(r[0], int(r[1])) + r[2:] for r in rows])
+        print("Exported {} rows, up to id {}"
+              "".format(columns.rows, columns.last_id), file=sys.stderr)
+
+
+def count(columns, bucket, keys):
+    """Count the rows in each time bucket for each combination of keys.
+
+    Returns a sorted list of (bucket start, key values..., count).
+    """
+    data = columns.load()
+    if numpy is None:
+        counter = collections.Counter(zip(
+            *[[v // bucket * bucket for v in data['time']]]
+            + [data[k] for k in keys]))
+        return [k + (n,) for k, n in sorted(counter.items())]
+
+    # Each combination of values is packed into a single integer, which
+    # are counted by sorting them.
+    groups = [data['time'] // bucket] + [data[k] for k in keys]
+    packed = numpy.zeros(columns.rows, numpy.int64)
+    lows, radixes = [], []
+    for values in groups:
+        low = int(values.min()) if columns.rows else 0
+        radix = int(values.max()) - low + 1 if columns.rows else 1
+        packed = packed * radix + (values.astype(numpy.int64) - low)
+        lows.append(low)
+        radixes.append(radix)
+    unique, counts = numpy.unique(packed, return_counts=True)
+
+    unpacked = []
+    for low, radix in zip(reversed(lows), reversed(radixes)):
+        unique, values = numpy.divmod(unique, radix)
+        unpacked.append(values + low)
+    unpacked.reverse()
+    unpacked[0] *= bucket
+    return [tuple(int(v) for v in row) + (int(n),)
+            for row, n in zip(zip(*unpacked), counts)]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    operations = parser.add_subparsers(dest='operation', metavar='operation')
+
+    export_parser = operations.add_parser(
+        'export', help="append the messages logged since the last export")
+    export_parser.add_argument('directory')
+    export_parser.add_argument('-a', '--archive', metavar='DIR',
+                               help="also export the messages archived to "
+                                    "this directory")
+
+    count_parser = operations.add_parser(
+        'count', help="count the exported messages over time")
+    count_parser.add_argument('directory')
+    count_parser.add_argument('-b', '--bucket', type=int, default=3600,
+                              help="length of the time buckets in seconds")
+    count_parser.add_argument('-k', '--key', action='append',
+                              choices=['dir', 'op', 't'],
+                              help="also group by this column, can be given "
+                                   "more than once")
+
+    args = parser.parse_args()
+
+    if args.operation == 'export':
+        import logging
+
+        from database import connect, load_config
+
+        config = load_config()
+        logging.basicConfig(level=logging.INFO)
+        connection = connect(config)
+        archive = Archive(args.archive) if args.archive else None
+        export(connection, Columns(args.directory), archive)
+
+    elif args.operation == 'count':
+        columns = Columns(args.directory)
+        keys = args.key or []
+        print('\t'.join(['time'] + keys + ['count', 'rate']))
+        for row in count(columns, args.bucket, keys):
+            start = datetime.datetime.utcfromtimestamp(row[0])
+            values = [start.strftime(TIME_FORMAT)]
+            for key, value in zip(keys, row[1:-1]):
+                if key == 't':
+                    value = columns.types[value]
+                elif key == 'op' and value == -1:
+                    value = None
+                values.append('NULL' if value is None else str(value))
+            values.append(str(row[-1]))
+            values.append('{:.3f}'.format(row[-1] / args.bucket))
+            print('\t'.join(values))
+
+    else:
+        parser.print_usage()
+        exit(1)
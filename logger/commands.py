@@ -0,0 +1,63 @@
+"""Background worker running the commands given to the bot."""
+
+import logging
+import queue
+import threading
+import time
+
+
+class TokenBucket:
+    """Limits actions to rate per second, in bursts of up to burst."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        """Wait until an action is allowed."""
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self.tokens = 1
+            self.updated = time.monotonic()
+        self.tokens -= 1
+
+
+class CommandWorker(threading.Thread):
+    """Runs handler on the messages put, one at a time.
+
+    The bot receives messages on the same thread as it logs them, so
+    commands, which wait on the Discord API, are handed to this thread.
+    Messages put while the queue is full are dropped rather than
+    holding up the logging.
+    """
+
+    def __init__(self, handler, queue_size=100):
+        threading.Thread.__init__(self, name='Commands', daemon=True)
+        self.handler = handler
+        self.queue = queue.Queue(queue_size)
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            logging.warning("Command queue full, dropping command")
+
+    def close(self):
+        """Stop the worker once the queued commands have run."""
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            try:
+                self.handler(message)
+            except Exception:
+                logging.exception("Command failed")
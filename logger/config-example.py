@@ -4,7 +4,8 @@
     # Most of these settings can be changed from within the bot
     # itself.  See the help command.
     'active_servers': set(),
-    'admin_commands': {'help', 'ignore_server', 'listen_on', 'leave', 'join'},
+    'admin_commands': {'help', 'ignore_server', 'listen_on', 'leave', 'join',
+                       'metrics'},
     'admin_roles': set(),
     'admins': set(),
 
@@ -12,12 +13,33 @@
     'bot_user': 'logger@example.com',
     'bot_password': 'Password for Discord user'
 
+    # Sessions to log in one process, each with a name that is stored
+    # with the messages it logs.  All sessions share one database
+    # writer.  When not set, bot_user is logged with no session name.
+    # Only the first session answers commands unless 'commands' is set
+    # for a session.  A session that fails is logged in again after
+    # session_retry_interval seconds.
+    # 'sessions': [
+    #     {'name': 'main', 'bot_user': 'logger@example.com',
+    #      'bot_password': 'Password for Discord user'},
+    #     {'name': 'second', 'bot_user': 'logger2@example.com',
+    #      'bot_password': 'Password for Discord user'},
+    # ],
+    'session_retry_interval': 30,
+
     # MySQL database connection.
     'db_host': 'localhost',
     'db_user': 'logger',
     'db_password': 'Password for database user',
     'db_schema': 'discord',
 
+    # Store raw messages zlib compressed, using the newest dictionary
+    # created by codec.py train.
+    'compress_raw': False,
+
+    # Seconds to wait on a database read or write before giving up.
+    'db_timeout': 30,
+
     'ignores': set(),
 
     # Set of user ids that are masters of bot, and can do any command.
@@ -30,4 +52,68 @@
     'trigger': '!',
 
     'user_commands': {'help', 'leave', 'join'},
+
+    # Commands are run by a background worker so they don't hold up the
+    # logging.  At most command_queue_size commands wait to be run, and
+    # replies are sent at send_rate messages per second, in bursts of
+    # up to send_burst messages.
+    'command_queue_size': 100,
+    'send_rate': 1.0,
+    'send_burst': 5,
+
+    # Messages are written to the database in batches by a background
+    # writer.  A batch is committed when it has write_batch_size rows
+    # or when its oldest row has waited write_flush_interval seconds.
+    # At most write_queue_size messages are held in memory waiting to
+    # be written.
+    'write_batch_size': 100,
+    'write_flush_interval': 1.0,
+    'write_queue_size': 10000,
+
+    # When the queue is full or the database is unavailable, messages
+    # are spilled to segment files in journal_dir and replayed into
+    # the database once it has caught up.  Replay is retried every
+    # write_retry_interval seconds while the database is down.
+    'journal_dir': 'journal',
+    'journal_segment_rows': 1000,
+    'write_retry_interval': 10.0,
+
+    # Store messages of at least dedup_size bytes once in the payload
+    # table, referenced by their hash, or None to store every message in
+    # full.  Repeated READY and GUILD_CREATE messages are the ones that
+    # benefit.  The hashes of the last dedup_cache payloads stored are
+    # kept in memory.
+    'dedup_size': None,
+    'dedup_cache': 10000,
+
+    # Port on localhost to serve the metrics of the logger on as plain
+    # text, or None to not serve them.  They are also summarised by the
+    # metrics command.
+    'metrics_port': 9108,
+
+    # The query service run by query.py listens on query_port on
+    # localhost and answers the queries of the web app, using up to
+    # query_pool_size connections as query_db_user, which should only
+    # have SELECT grants.
+    'query_port': 9109,
+    'query_pool_size': 4,
+    'query_db_user': 'web',
+    'query_db_password': 'Password for web database user',
+
+    # Bytes of query results the query service keeps cached until
+    # messages are logged or archived, or for at most query_cache_age
+    # seconds.  Only queries reading the message and rollup tables alone
+    # are cached.
+    'query_cache_size': 64 * 1024 * 1024,
+    'query_cache_age': 60,
+
+    # Messages logged more than archive_after_days days ago are moved
+    # to compressed files in archive_dir by archive.py, which has to be
+    # more than 1 when dedup_size is set.
+    'archive_dir': 'archive',
+    'archive_after_days': 90,
+
+    # Keys whose values are indexed by keyindex.py, wherever they are in
+    # the messages.
+    'index_keys': ['id', 'channel_id', 'guild_id', 'user_id', 'message_id'],
 }
@@ -0,0 +1,22 @@
+"""Configuration and database connection shared by the logger programs."""
+
+import pymysql
+
+
+# All connections use UTC, so times written and read are unaffected by
+# the time zone of the server and the client.
+INIT_COMMAND = "SET time_zone = '+00:00'"
+
+
+def load_config():
+    return eval(open('config.py').read())
+
+def connect(config, init_command=INIT_COMMAND, **options):
+    # The init command is run again whenever the connection reconnects.
+    return pymysql.connect(host=config['db_host'],
+                           user=config['db_user'],
+                           password=config['db_password'],
+                           db=config['db_schema'],
+                           charset='utf8mb4',
+                           init_command=init_command,
+                           **options)
@@ -0,0 +1,99 @@
+"""Append-only journal of messages waiting to be written to the database."""
+
+import json
+import logging
+import os
+import time
+import uuid
+
+
+class Journal:
+    """Rows spilled to segment files in a directory.
+
+    Rows are appended to the current segment, which is sealed once it
+    holds segment_rows rows or when seal() is called.  Segment names
+    sort in the order their rows should be replayed and are unique, so
+    a segment that has been replayed can be recognised by its name.
+    """
+
+    def __init__(self, path, segment_rows=1000):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_rows = segment_rows
+        self._file = None
+        self._rows = 0
+        self._last = 0
+
+    def segments(self):
+        """Paths of the sealed segments, oldest first."""
+        names = [n for n in os.listdir(self.path) if n.endswith('.jsonl')]
+        paths = [os.path.join(self.path, n) for n in sorted(names)]
+        if self._file is not None:
+            paths.remove(self._file.name)
+        return paths
+
+    def count(self):
+        """Number of segment files, including the current one."""
+        return len([n for n in os.listdir(self.path) if n.endswith('.jsonl')])
+
+    def _open(self, sequence):
+        name = '{:020d}-{}.jsonl'.format(sequence, uuid.uuid4().hex)
+        return open(os.path.join(self.path, name), 'w', encoding='utf-8')
+
+    def append(self, row):
+        if self._file is None:
+            self._last = max(time.time_ns(), self._last + 1)
+            self._file = self._open(self._last)
+
+        self._file.write(json.dumps(row))
+        self._file.write('\n')
+        self._file.flush()
+        self._rows += 1
+        if self._rows >= self.segment_rows:
+            self.seal()
+
+    def seal(self):
+        """Close the current segment and return all sealed segments."""
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            self._rows = 0
+        return self.segments()
+
+    def prepend(self, rows):
+        """Write rows to a sealed segment ordered before all others."""
+        names = [os.path.basename(p) for p in self.segments()]
+        if self._file is not None:
+            names.append(os.path.basename(self._file.name))
+        if names:
+            sequence = min(int(n.split('-')[0]) for n in names) - 1
+        else:
+            sequence = time.time_ns()
+
+        with self._open(sequence) as segment:
+            for row in rows:
+                segment.write(json.dumps(row))
+                segment.write('\n')
+            segment.flush()
+            os.fsync(segment.fileno())
+
+    def read(self, path):
+        with open(path, encoding='utf-8') as segment:
+            for line in segment:
+                try:
+                    yield tuple(json.loads(line))
+                except ValueError:
+                    # Only the last line can be cut short by a crash.
+                    logging.warning("Skipping damaged line in %s", path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def set_aside(self, path):
+        """Move a segment that can't be replayed out of the way."""
+        os.rename(path, path + '.failed')
+
+
+def segment_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
@@ -0,0 +1,166 @@
+"""Index of the values of selected keys in the logged messages.
+
+Each message is walked once, and the scalar values of keys named in
+index_keys are stored in the keyindex table with the path to them and
+the id of the message.  Paths are the keys from the top of the message
+joined by dots, with [] for the items of a list, like d.author.id or
+d.guilds[].id.  These are the paths of the nodes of the analysis,
+except that it splits unavailable guilds from the others.
+
+The walk isn't shared with the analysis, which builds its tree in the
+same recursion and has no use for the paths, as making the paths of a
+message alone takes about 40% of the time of analyzing it.
+
+Messages are indexed in id order, and the highest id indexed is kept
+in keyindex_state in the same transaction as the index rows, so
+indexing can be interrupted and continues where it left off.
+"""
+
+import json
+import sys
+import time
+
+from codec import RAW_SQL, Codec, load_dictionaries
+
+
+INDEX_SQL = "INSERT IGNORE INTO keyindex (path, value, id) VALUES (%s, %s, %s)"
+
+DEFAULT_KEYS = ['id', 'channel_id', 'guild_id', 'user_id', 'message_id']
+
+# Longest value stored, longer values are left out of the index.
+MAX_VALUE = 255
+
+
+def key_values(leaf, keys, path=''):
+    """Generate the (path, value) pairs of the keys in a decoded message."""
+    if isinstance(leaf, dict):
+        for k, v in leaf.items():
+            child = path + '.' + k if path else k
+            if k in keys and isinstance(v, (str, int)) \
+                    and not isinstance(v, bool):
+                value = str(v)
+                if len(value) <= MAX_VALUE:
+                    yield child, value
+            else:
+                yield from key_values(v, keys, child)
+    elif isinstance(leaf, list):
+        for v in leaf:
+            yield from key_values(v, keys, path + '[]')
+
+def index_rows(rows, codec, keys):
+    """Rows of the keyindex table for (id, raw) rows of message."""
+    entries = []
+    for row_id, raw in rows:
+        try:
+            data = json.loads(codec.decode(raw))
+        except ValueError:
+            print("error decoding", row_id, file=sys.stderr)
+            continue
+        # The same id is often repeated in a message.
+        entries.extend((path, value, row_id)
+                       for path, value in set(key_values(data, keys)))
+    return entries
+
+def indexed_id(cursor):
+    cursor.execute("SELECT last_id FROM keyindex_state")
+    row = cursor.fetchone()
+    return row[0] if row is not None else 0
+
+def update(connection, keys, chunk_size=1000):
+    """Index the messages logged since the last update."""
+    codec = Codec(load_dictionaries(connection))
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MAX(id) FROM message")
+        high = cursor.fetchone()[0] or 0
+        last = indexed_id(cursor)
+    connection.commit()
+
+    indexed = 0
+    while last < high:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id, {} FROM message "
+                           "WHERE id > %s AND id <= %s ORDER BY id LIMIT %s"
+                           "".format(RAW_SQL), (last, high, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            try:
+                entries = index_rows(rows, codec, keys)
+            except KeyError:
+                # Compressed with a dictionary made since the
+                # dictionaries were loaded.
+                codec = Codec(load_dictionaries(connection))
+                entries = index_rows(rows, codec, keys)
+            cursor.executemany(INDEX_SQL, entries)
+
+            last = rows[-1][0]
+            cursor.execute("DELETE FROM keyindex_state")
+            cursor.execute("INSERT INTO keyindex_state (last_id) VALUES (%s)",
+                           (last,))
+        connection.commit()
+
+        indexed += len(rows)
+        print("Indexed {} rows, at id {} of {}".format(indexed, last, high),
+              file=sys.stderr)
+    return indexed
+
+def follow(connection, keys, interval, chunk_size=1000):
+    """Keep indexing new messages, checking for them every interval."""
+    while True:
+        update(connection, keys, chunk_size)
+        time.sleep(interval)
+
+def lookup(connection, path, value, after=0, limit=100):
+    """Messages with value at path, as (id, time, t) rows in id order."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT message.id, message.time, message.t "
+                       "FROM keyindex JOIN message USING (id) "
+                       "WHERE keyindex.path = %s AND keyindex.value = %s "
+                       "AND keyindex.id > %s ORDER BY keyindex.id LIMIT %s",
+                       (path, value, after, limit))
+        return cursor.fetchall()
+
+
+if __name__ == '__main__':
+    import argparse
+    import logging
+
+    from database import connect, load_config
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update_parser = subparsers.add_parser(
+        'update', help="index the messages logged since the last update")
+    update_parser.add_argument('-f', '--follow', metavar='SECONDS',
+                               type=float, help="keep indexing new messages, "
+                                                "checking this often")
+    update_parser.add_argument('-c', '--chunk-size', type=int, default=1000,
+                               help="rows indexed per transaction")
+
+    lookup_parser = subparsers.add_parser(
+        'lookup', help="list the messages with a value at a path")
+    lookup_parser.add_argument('path', help="path to the key, like "
+                                            "d.author.id")
+    lookup_parser.add_argument('value')
+    lookup_parser.add_argument('-a', '--after', type=int, default=0,
+                               help="only list messages after this id")
+    lookup_parser.add_argument('-n', '--limit', type=int, default=100,
+                               help="most messages to list")
+    args = parser.parse_args()
+
+    config = load_config()
+    logging.basicConfig(level=logging.INFO)
+    connection = connect(config)
+    keys = set(config.get('index_keys', DEFAULT_KEYS))
+
+    if args.command == 'update':
+        if args.follow is not None:
+            follow(connection, keys, args.follow, args.chunk_size)
+        else:
+            update(connection, keys, args.chunk_size)
+    else:
+        for row_id, logged, t in lookup(connection, args.path, args.value,
+                                        args.after, args.limit):
+            print(row_id, logged, t or '')
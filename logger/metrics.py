@@ -0,0 +1,198 @@
+"""Counters and histograms of the messages logged and written.
+
+The metrics are shown as plain text in the Prometheus exposition
+format, by an HTTP server on localhost and summarised by the metrics
+command of the bot.
+"""
+
+import bisect
+import collections
+import http.server
+import threading
+import time
+
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, or None if
+        nothing was observed.
+        """
+        if self.count == 0:
+            return None
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= q * self.count:
+                return bound
+        return float('inf')
+
+    def lines(self, name):
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            yield '{}_bucket{{le="{}"}} {}'.format(name, bound, total)
+        yield '{}_bucket{{le="+Inf"}} {}'.format(name, self.count)
+        yield '{}_sum {}'.format(name, self.sum)
+        yield '{}_count {}'.format(name, self.count)
+
+
+def seconds(value):
+    return 'n/a' if value is None else '{}s'.format(value)
+
+
+class Metrics:
+    """Metrics of the logger, safe to update from any thread.
+
+    Gaps in the sequence numbers of received dispatches are counted
+    as missing messages, separately for each logger session.  A READY
+    starts a new sequence, and a resumed session replays the dispatches
+    after the last one received, so sequence numbers at or below the
+    last one are counted as replayed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.messages = collections.Counter()
+        self.bytes = collections.Counter()
+        self.insert_latency = Histogram()
+        self.commit_latency = Histogram()
+        self.write_lag = Histogram()
+        self.gauges = {}
+
+        self.sequences = {}
+        self.sessions = 0
+        self.resumes = 0
+        self.gaps = 0
+        self.missing = 0
+        self.replayed = 0
+
+    def gauge(self, name, func):
+        """Show the value returned by func as name."""
+        self.gauges[name] = func
+
+    def logged(self, row):
+        """Record a row made by writer.make_row."""
+        logged, direction, op, s, t, part, size, session, raw = row
+        key = (direction, '' if t is None else t)
+        with self.lock:
+            self.messages[key] += 1
+            self.bytes[key] += size
+            if direction == 0 and op == 0 and s is not None:
+                self._sequence(session, s, t)
+
+    def _sequence(self, session, s, t):
+        last = self.sequences.get(session)
+        if t == 'READY':
+            self.sessions += 1
+        elif t == 'RESUMED':
+            self.resumes += 1
+        elif last is not None:
+            if s > last + 1:
+                self.gaps += 1
+                self.missing += s - last - 1
+            elif s <= last:
+                self.replayed += 1
+                return
+        self.sequences[session] = s
+
+    def written(self, batch, insert_time, commit_time):
+        """Record the time taken to write a batch of rows."""
+        now = time.time()
+        with self.lock:
+            self.insert_latency.observe(insert_time)
+            self.commit_latency.observe(commit_time)
+            # Rows are written in order, the first row waited longest.
+            self.write_lag.observe(now - batch[0][0])
+
+    def text(self):
+        with self.lock:
+            lines = ['logger_uptime_seconds {:.0f}'.format(
+                time.time() - self.started)]
+            for name, counter in (('logger_messages_total', self.messages),
+                                  ('logger_message_bytes_total', self.bytes)):
+                for (direction, t), value in sorted(counter.items()):
+                    lines.append('{}{{dir="{}",t="{}"}} {}'.format(
+                        name, ['receive', 'send'][direction], t, value))
+            lines.extend(self.insert_latency.lines('logger_insert_seconds'))
+            lines.extend(self.commit_latency.lines('logger_commit_seconds'))
+            lines.extend(self.write_lag.lines('logger_write_lag_seconds'))
+            for session, s in sorted(self.sequences.items(),
+                                     key=lambda item: item[0] or ''):
+                lines.append('logger_sequence{{session="{}"}} {}'.format(
+                    session or '', s))
+            lines.append('logger_sessions_total {}'.format(self.sessions))
+            lines.append('logger_resumes_total {}'.format(self.resumes))
+            lines.append('logger_sequence_gaps_total {}'.format(self.gaps))
+            lines.append('logger_sequence_missing_total {}'.format(
+                self.missing))
+            lines.append('logger_sequence_replayed_total {}'.format(
+                self.replayed))
+
+        for name, func in sorted(self.gauges.items()):
+            lines.append('{} {}'.format(name, func()))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Short summary of the metrics for the metrics command."""
+        gauges = {name: func() for name, func in self.gauges.items()}
+        with self.lock:
+            received = sum(v for (d, t), v in self.messages.items() if d == 0)
+            sent = sum(v for (d, t), v in self.messages.items() if d == 1)
+            return (
+                "Logged {} received and {} sent messages in {:.0f} minutes.\n"
+                "Insert p50 {} p99 {}, commit p50 {} p99 {}, "
+                "lag p99 {}.\n"
+                "Queue depth {}, journal segments {}.\n"
+                "Sequence gaps {} missing {} messages, {} sessions, "
+                "{} resumes.".format(
+                    received, sent, (time.time() - self.started) / 60,
+                    seconds(self.insert_latency.quantile(0.5)),
+                    seconds(self.insert_latency.quantile(0.99)),
+                    seconds(self.commit_latency.quantile(0.5)),
+                    seconds(self.commit_latency.quantile(0.99)),
+                    seconds(self.write_lag.quantile(0.99)),
+                    gauges.get('logger_write_queue_depth'),
+                    gauges.get('logger_journal_segments'),
+                    self.gaps, self.missing, self.sessions, self.resumes))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(metrics, port):
+    """Serve the metrics on localhost port from a background thread."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port),
+                                             MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever, name='Metrics',
+                              daemon=True)
+    thread.start()
+    return server
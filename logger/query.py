@@ -0,0 +1,483 @@
+"""Read-only query service for the web app.
+
+Queries are run on a pool of read-only connections and the results are
+streamed as newline delimited JSON.  The first line holds the fields of
+the result, then there's one line with an array for each row, and the
+last line holds the id to continue from for the next page, or null.
+
+Results of the message table alone with an id column are paged in id
+order, so each page is read with an index lookup on the id it starts
+after, however far into the result it is.  Other results are cut off
+after one page, and the query is limited to that page where it can be.
+Values of columns named raw are decoded and have payload references
+resolved.
+
+Pages of queries that read nothing but the message and rollup tables
+are cached until rows are added to or removed from message, which is
+noticed by its lowest and highest id changing.  The writer updates the
+rollup in the same transaction as it adds the messages it counts.
+Pages are kept for at most max_age seconds, as rows updated in place by
+backfill.py and codec.py migrate, and a rollup rebuilt by rollup.py,
+can't be noticed.
+"""
+
+import collections
+import datetime
+import http.server
+import itertools
+import json
+import logging
+import queue
+import re
+import threading
+import time
+import urllib.parse
+
+import pymysql
+
+from codec import Codec, is_reference, load_dictionaries
+from database import INIT_COMMAND, connect
+
+
+PAGE_SQL = ("SELECT * FROM ({}) page WHERE page.id > %s "
+            "ORDER BY page.id LIMIT %s")
+
+# Results of queries with a LIMIT of their own are capped from outside.
+CAPPED_SQL = "SELECT * FROM ({}) capped LIMIT %s"
+
+# Errors from PAGE_SQL for results that can't be paged by id.
+NOT_PAGEABLE = {
+    1054,  # Unknown column page.id
+    1060,  # Duplicate column name
+}
+
+MAX_PAGE = 10000
+
+
+class Pool:
+    """Fixed number of read-only connections shared between threads."""
+
+    def __init__(self, config, size):
+        self.config = config
+        self.connections = queue.Queue()
+        for i in range(size):
+            self.connections.put(None)
+
+    def _connect(self):
+        # Each query sees the rows committed before it.  The connection
+        # is made read-only by the init command, so it stays read-only
+        # when ping reconnects it.
+        return connect(self.config, autocommit=True,
+                       init_command=INIT_COMMAND
+                       + ", SESSION transaction_read_only = 1")
+
+    def get(self):
+        connection = self.connections.get()
+        try:
+            if connection is None:
+                connection = self._connect()
+            else:
+                connection.ping(reconnect=True)
+        except pymysql.MySQLError:
+            self.connections.put(None)
+            raise
+        return connection
+
+    def put(self, connection, broken=False):
+        if broken:
+            connection.close()
+            connection = None
+        self.connections.put(connection)
+
+
+class Result:
+    """Lines of a page of a result, and the id range it was read at."""
+
+    def __init__(self, bounds, fields, lines, last_id, more, paged,
+                 read_at=None):
+        self.bounds = bounds
+        self.fields = fields
+        self.lines = lines
+        self.last_id = last_id
+        self.more = more
+        self.paged = paged
+        self.read_at = time.monotonic() if read_at is None else read_at
+        self.size = sum(len(line) for line in lines)
+
+    def output(self):
+        yield json_line({'fields': self.fields})
+        yield from self.lines
+        next_id = self.last_id if self.paged and self.more else None
+        yield json_line({'next': next_id, 'more': self.more})
+
+
+class ResultCache:
+    """Results of queries, evicting the least recently used ones.
+
+    Results are kept up to max_size bytes in total, ones larger than a
+    quarter of that are not kept.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.results = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            old = self.results.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            if result.size > self.max_size // 4:
+                return
+
+            self.results[key] = result
+            self.size += result.size
+            while self.size > self.max_size:
+                key, old = self.results.popitem(last=False)
+                self.size -= old.size
+
+
+class QueryService:
+    def __init__(self, pool, cache_size=64 << 20, max_age=60):
+        self.pool = pool
+        self.codec = None
+        self.cache = ResultCache(cache_size)
+        self.max_age = max_age
+
+    def fetch_page(self, connection, sql, after, limit):
+        """Return the fields, rows, if there are more rows and the index
+        of the id column, which is None if the result isn't paged by id.
+        """
+        if is_pageable(sql):
+            # The query is formatted with the page arguments by pymysql,
+            # so any % in it has to be escaped.
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(PAGE_SQL.format(sql.replace('%', '%%')),
+                                   (after, limit + 1))
+                    rows = cursor.fetchall()
+                    fields = [{'name': d[0], 'type': d[1]}
+                              for d in cursor.description]
+            except pymysql.MySQLError as e:
+                if e.args[0] not in NOT_PAGEABLE:
+                    raise
+            else:
+                index = [f['name'] for f in fields].index('id')
+                return fields, rows[:limit], len(rows) > limit, index
+
+        # Closing a streamed result reads the rest of it, so the query
+        # is limited to one more row than the page where it can be.
+        # Other statements, like SHOW, are streamed as they are.
+        capped = cap(sql)
+        if capped is not None:
+            try:
+                return self.stream(connection, capped, (limit + 1,), limit)
+            except pymysql.MySQLError as e:
+                # Subqueries can't have duplicate column names.
+                if e.args[0] not in NOT_PAGEABLE:
+                    raise
+        return self.stream(connection, sql, None, limit)
+
+    def stream(self, connection, sql, args, limit):
+        with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(sql, args)
+            rows = cursor.fetchmany(limit)
+            more = cursor.fetchone() is not None
+            fields = [{'name': d[0], 'type': d[1]} for d in cursor.description]
+        return fields, rows, more, None
+
+    def read(self, connection, sql, after, limit, bounds):
+        fields, rows, more, index = self.fetch_page(connection, sql, after,
+                                                    limit)
+        rows = self.decode_raw(connection, fields, rows)
+        last_id = rows[-1][index] if rows and index is not None else after
+        return Result(bounds, fields, [json_line(row) for row in rows],
+                      last_id, more, index is not None)
+
+    def extend(self, connection, sql, result, limit, bounds):
+        """Add the rows added to the table since result was read."""
+        # Only rows after the ones in the table when the result was read
+        # can have been added to it.  The rows already read are as old
+        # as before.
+        after = max(result.last_id, result.bounds[1] or 0)
+        fields, rows, more, index = self.fetch_page(
+            connection, sql, after, limit - len(result.lines))
+        rows = self.decode_raw(connection, fields, rows)
+        last_id = rows[-1][index] if rows else result.last_id
+        return Result(bounds, result.fields,
+                      result.lines + [json_line(row) for row in rows],
+                      last_id, more, True, result.read_at)
+
+    def decode_raw(self, connection, fields, rows):
+        columns = [i for i, f in enumerate(fields) if f['name'] == 'raw']
+        if not columns:
+            return rows
+
+        hashes = {row[i][1:] for row in rows for i in columns
+                  if row[i] is not None and is_reference(row[i])}
+        payloads = {}
+        if hashes:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT hash, raw FROM payload "
+                               "WHERE hash IN %s", (list(hashes),))
+                payloads = dict(cursor.fetchall())
+
+        if self.codec is None:
+            self.codec = Codec(load_dictionaries(connection))
+
+        decoded = []
+        for row in rows:
+            row = list(row)
+            for i in columns:
+                value = row[i]
+                if value is not None and is_reference(value):
+                    value = payloads.get(bytes(value[1:]))
+                if value is not None:
+                    try:
+                        value = self.codec.decode(value)
+                    except KeyError:
+                        # Compressed with a dictionary made since the
+                        # dictionaries were loaded.
+                        self.codec = Codec(load_dictionaries(connection))
+                        value = self.codec.decode(value)
+                row[i] = value
+            decoded.append(row)
+        return decoded
+
+    def query(self, sql, after=0, limit=1000):
+        """Generate the lines of the result of a query.
+
+        Results of queries that read nothing but CACHED_TABLES are
+        cached for as long as the range of ids in message stays the
+        same, up to max_age seconds.  Results of queries that only select rows
+        from the message table are extended with the rows added since,
+        if they didn't fill their page.
+        """
+        # The query is put in a subquery to page it.
+        sql = sql.strip().rstrip(';')
+        key = (normalize(sql), after, limit)
+        cacheable = is_cacheable(key[0])
+        connection = self.pool.get()
+        broken = False
+        try:
+            result = bounds = None
+            if cacheable:
+                with connection.cursor() as cursor:
+                    cursor.execute("SHOW TABLES")
+                    tables = {row[0].lower() for row in cursor.fetchall()}
+                    cacheable = not reads_other_tables(key[0], tables)
+                    if cacheable:
+                        cursor.execute("SELECT MIN(id), MAX(id) FROM message")
+                        bounds = tuple(cursor.fetchone())
+                if cacheable:
+                    result = self.cache.get(key)
+                if (result is not None and time.monotonic() - result.read_at
+                        > self.max_age):
+                    result = None
+
+            if result is not None and result.bounds == bounds:
+                pass
+            elif (result is not None and result.paged and not result.more
+                  and result.bounds[0] == bounds[0]
+                  and is_append_only(key[0])):
+                result = self.extend(connection, sql, result, limit, bounds)
+            else:
+                result = self.read(connection, sql, after, limit, bounds)
+        except pymysql.MySQLError as e:
+            # Client errors, 2000 and up, are from the connection and
+            # not the query.
+            code = e.args[0] if e.args else None
+            broken = (isinstance(e, pymysql.InterfaceError)
+                      or isinstance(code, int) and code >= 2000)
+            raise
+        finally:
+            self.pool.put(connection, broken)
+
+        if cacheable:
+            self.cache.put(key, result)
+        yield from result.output()
+
+
+_quoted = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)""")
+
+# Functions whose value changes without the table changing.
+_volatile = re.compile(r'\b(now|sysdate|curdate|curtime|current_date|'
+                       r'current_time|current_timestamp|localtime|'
+                       r'localtimestamp|utc_date|utc_time|utc_timestamp|'
+                       r'unix_timestamp|rand|uuid|connection_id)\b')
+
+# Queries selecting from the message table by conditions on each row,
+# which rows added later can't change the result of for earlier rows.
+_selection = re.compile(r'select (.+) from message( where (.+))?')
+_not_selection = re.compile(r'\b(select|from|group|order|limit|join|union|'
+                            r'having|distinct|into|count|sum|min|max|avg|'
+                            r'group_concat|std|stddev|variance)\b')
+
+# Tables that only change along with the range of ids in message.
+CACHED_TABLES = {'message', 'rollup'}
+
+# Databases other than the one logged to, which can't be told apart from
+# table names in the query.
+_other_databases = {'information_schema', 'performance_schema', 'mysql',
+                    'sys'}
+
+_name = re.compile(r'\w+')
+
+_parenthesised = re.compile(r'\([^()]*\)')
+# Queries of the message table alone, where id is unique.  The keyword
+# checks are left to _not_unique.
+_message_only = re.compile(r'select (.*) from message( (as )?\w+)?'
+                           r'( (where|order by|limit) .*)?')
+_not_unique = re.compile(r'\b(join|group|having|union)\b|\bas id\b')
+_limit = re.compile(r'\blimit\b')
+_locking = re.compile(r'\b(for update|lock in share mode|for share|into)\b')
+_order = re.compile(r'\border by (.*?)( limit\b.*)?$')
+_id_order = re.compile(r'(\w+\.)?id( asc)?')
+
+def normalize(sql):
+    """Query with whitespace outside of quotes collapsed."""
+    parts = _quoted.split(sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = ' '.join(parts[i].split())
+    return ''.join(parts)
+
+def unquoted(sql):
+    """Lower case query with quoted strings and names blanked out."""
+    return ''.join(part if i % 2 == 0 else "''"
+                   for i, part in enumerate(_quoted.split(sql))).lower()
+
+def top_level(sql):
+    """Lower case clauses of the outermost query of sql."""
+    top = unquoted(normalize(sql))
+    # Parenthesised parts, like subqueries, are removed from the inside
+    # out.
+    while True:
+        stripped = _parenthesised.sub('', top)
+        if stripped == top:
+            return top
+        top = stripped
+
+def is_pageable(sql):
+    """If paging by id keeps the order and all the rows of the query.
+
+    Paging orders the result by id, which would override any other order
+    the query asks for, and continues after the last id of a page, which
+    would skip rows with the same id.  Only ids of the message table by
+    itself are known to be unique.
+    """
+    top = top_level(sql)
+    if _message_only.fullmatch(top) is None or _not_unique.search(top):
+        return False
+    match = _order.search(top)
+    return match is None or _id_order.fullmatch(match.group(1)) is not None
+
+def cap(sql):
+    """sql limited to a number of rows given as an argument, or None."""
+    top = top_level(sql)
+    if not top.startswith('select ') or _locking.search(top):
+        return None
+    escaped = sql.replace('%', '%%')
+    if _limit.search(top):
+        return CAPPED_SQL.format(escaped)
+    return escaped + " LIMIT %s"
+
+def is_cacheable(sql):
+    return _volatile.search(unquoted(sql)) is None
+
+def reads_other_tables(sql, tables):
+    """If the query may read anything but CACHED_TABLES.
+
+    Any name in the query that is another table or database counts,
+    even if it's an alias or a column.
+    """
+    names = set(_name.findall(unquoted(sql)))
+    names.update(part[1:-1].lower() for part in _quoted.findall(sql)
+                 if part.startswith('`'))
+    others = (tables - CACHED_TABLES) | _other_databases
+    return not names.isdisjoint(others)
+
+def is_append_only(sql):
+    match = _selection.fullmatch(unquoted(sql))
+    return (match is not None
+            and _not_selection.search(match.group(1)) is None
+            and _not_selection.search(match.group(3) or '') is None)
+
+
+def json_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode('utf-8', 'replace')
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(value)
+
+def json_line(value):
+    return (json.dumps(value, default=json_value) + '\n').encode('utf-8')
+
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        try:
+            sql = params['q'][0]
+            after = int(params.get('after', ['0'])[0])
+            limit = min(int(params.get('limit', ['1000'])[0]), MAX_PAGE)
+        except (KeyError, ValueError):
+            self.send_lines(400, [json_line({
+                'error': "Expected q, and integer after and limit"})])
+            return
+
+        try:
+            lines = self.server.service.query(sql, after, limit)
+            first = next(lines)
+        except pymysql.MySQLError as e:
+            self.send_lines(400, [json_line({'error': str(e.args[-1])})])
+            return
+        except Exception:
+            logging.exception("Query failed: %s", sql)
+            self.send_lines(500, [json_line({
+                'error': "Query service error, see its log"})])
+            return
+        self.send_lines(200, itertools.chain([first], lines))
+
+    def send_lines(self, code, lines):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for line in lines:
+            self.wfile.write(line)
+
+    def log_message(self, format, *args):
+        logging.info("%s %s", self.address_string(), format % args)
+
+
+def serve(config):
+    db_config = dict(config,
+                     db_user=config.get('query_db_user', config['db_user']),
+                     db_password=config.get('query_db_password',
+                                            config['db_password']))
+    pool = Pool(db_config, config.get('query_pool_size', 4))
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', config.get('query_port', 9109)), QueryHandler)
+    server.daemon_threads = True
+    server.service = QueryService(
+        pool, config.get('query_cache_size', 64 << 20),
+        config.get('query_cache_age', 60))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    from database import load_config
+
+    config = load_config()
+    logging.basicConfig(level=logging.INFO)
+    serve(config)
@@ -0,0 +1,69 @@
+"""Masking of session ids and tokens in logged messages."""
+
+import json
+import re
+
+
+SENSITIVE_KEYS = ('session_id', 'token')
+REPLACEMENT = '[REDACTED]'
+
+# Matches the rest of a key after its name, up to a string value.
+_string_value = re.compile(r'"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+# Escapes of "_" and the lower case letters, which could spell a key.
+_key_escape = re.compile(r'\\u00(?:5f|6[0-9a-f]|7[0-9a])', re.IGNORECASE)
+
+
+def find_values(raw, key):
+    """Find the string values of key in the raw JSON text raw."""
+    needle = '"{}'.format(key)
+    values = []
+    start = raw.find(needle)
+    while start != -1:
+        # A key can only start at a quote that is not escaped, so this
+        # never matches inside a string.
+        if start == 0 or raw[start - 1] != '\\':
+            match = _string_value.match(raw, start + len(needle))
+            if match is not None:
+                values.append(json.loads(match.group(1)))
+        start = raw.find(needle, start + len(needle))
+    return values
+
+
+def redact(raw):
+    """Mask the values of sensitive keys in the raw JSON text raw.
+
+    Gives the same result as redact_tree, but finds the values by
+    scanning the text instead of decoding and walking the JSON.
+    """
+    if '\\u00' in raw and _key_escape.search(raw):
+        # A key could be spelled with escapes, fall back to decoding.
+        return redact_tree(raw)
+
+    values = []
+    for key in SENSITIVE_KEYS:
+        values.extend(find_values(raw, key))
+    if not values:
+        return raw
+
+    if len(set(values)) > 1:
+        # With several values the order of the replacements can matter.
+        return redact_tree(raw)
+
+    for value in values:
+        raw = raw.replace(value, REPLACEMENT)
+    return raw
+
+
+def redact_tree(raw):
+    """Mask sensitive values by walking the decoded JSON of raw."""
+    backlog = [('', json.loads(raw))]
+    while len(backlog):
+        n, e = backlog.pop()
+        if type(e) == dict:
+            backlog.extend([(k, v) for k, v in e.items()])
+        elif type(e) == list:
+            backlog.extend([('', v) for v in e])
+        elif n in SENSITIVE_KEYS and type(e) == str:
+            raw = raw.replace(e, REPLACEMENT)
+    return raw
@@ -0,0 +1,296 @@
+"""Replay of recorded traffic through the logger, for load testing.
+
+Frames are pushed through on_socket_raw_receive and on_socket_raw_send
+of a LoggerBot at the rate they were logged, sped up by a factor, or at
+a fixed rate.  The rows are written by a Writer to an in-process
+stand-in for the database, which takes a set time for each insert and
+commit, so the logger can be tested without a database or a Discord
+connection.
+
+Frames are read from a file written by the export command, with one
+JSON array of the unix time, direction and raw text of a frame on each
+line, or from a file with one raw frame on each line as used by
+bench.py, or made by the frame generator of bench.py.  Frames without
+a time are replayed at a fixed rate, or as fast as they can be.
+
+The report shows the rate frames were logged at, how late the replay
+fell behind its schedule, the lag from logging a row to committing it,
+and the rows that were spilled to the journal or not written at all.
+"""
+
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+import pymysql
+
+from codec import RAW_SQL, Codec, load_dictionaries
+from journal import Journal
+from metrics import Metrics
+from writer import INSERT_SQL, Writer
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, sql, args=None):
+        # Only journal_segment is queried, and no segment was replayed.
+        self.rows = []
+        return 0
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        if sql == INSERT_SQL and rows:
+            connection = self.connection
+            time.sleep(connection.insert_latency
+                       + connection.row_latency * len(rows))
+            connection.pending.extend(rows)
+        return len(rows)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+
+class FakeConnection:
+    """Stand-in for the writer's database connection.
+
+    Inserts take insert_latency seconds plus row_latency for each row,
+    and commits take commit_latency.  The lag of each row from being
+    logged to being committed is kept in lags.
+    """
+
+    def __init__(self, insert_latency=0, row_latency=0, commit_latency=0):
+        self.insert_latency = insert_latency
+        self.row_latency = row_latency
+        self.commit_latency = commit_latency
+        self.pending = []
+        self.inserted = 0
+        self.lags = []
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        time.sleep(self.commit_latency)
+        # Rows have the time they were logged as a UTC datetime.
+        now = datetime.datetime.utcnow()
+        self.lags.extend((now - row[0]).total_seconds()
+                         for row in self.pending)
+        self.inserted += len(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def ping(self, reconnect=False):
+        pass
+
+
+def read_frames(path):
+    """Generate (time, direction, raw) from a file, time may be None."""
+    with open(path, encoding='utf-8') as frames_file:
+        for line in frames_file:
+            if not line.strip():
+                continue
+            frame = json.loads(line)
+            if isinstance(frame, list):
+                yield tuple(frame)
+            else:
+                yield None, 0, line.rstrip('\n')
+
+def generate_frames(count, seed=0):
+    from bench import FrameGenerator
+
+    for raw in FrameGenerator(seed).frames(count):
+        yield None, 0, raw
+
+def export(connection, path, where=None, limit=None):
+    """Write the frames of messages in id order to a file for replay."""
+    codec = Codec(load_dictionaries(connection))
+    sql = ("SELECT UNIX_TIMESTAMP(time), dir, {} FROM message{} ORDER BY id"
+           "".format(RAW_SQL, " WHERE " + where if where else ""))
+    if limit is not None:
+        sql += " LIMIT {:d}".format(limit)
+
+    exported = 0
+    with connection.cursor(pymysql.cursors.SSCursor) as cursor, \
+            open(path, 'w', encoding='utf-8') as frames_file:
+        cursor.execute(sql)
+        for logged, direction, raw in cursor:
+            frames_file.write(json.dumps([float(logged), direction,
+                                          codec.decode(raw)]))
+            frames_file.write('\n')
+            exported += 1
+    print("Exported {} frames".format(exported), file=sys.stderr)
+
+def schedule(frames, speed=None, rate=None):
+    """Generate (seconds from start, direction, raw) for frames.
+
+    Frames with times are spaced by their times divided by speed, and
+    frames are spaced 1 / rate seconds apart if rate is given.  Without
+    either, every frame is due at once.
+    """
+    first = None
+    for i, (logged, direction, raw) in enumerate(frames):
+        if rate is not None:
+            due = i / rate
+        elif speed is not None and logged is not None:
+            if first is None:
+                first = logged
+            due = (logged - first) / speed
+        else:
+            due = 0
+        yield due, direction, raw
+
+def quantiles(values, points=(0.5, 0.99, 1.0)):
+    values = sorted(values)
+    if not values:
+        return [0.0 for point in points]
+    return [values[min(int(point * len(values)), len(values) - 1)]
+            for point in points]
+
+def replay(config, frames, connection, speed=None, rate=None):
+    """Push frames through a LoggerBot writing to connection.
+
+    Returns a dict with the results of the replay.
+    """
+    from bot import LoggerBot
+
+    metrics = Metrics()
+    with tempfile.TemporaryDirectory() as journal_dir:
+        journal = Journal(journal_dir, config.get('journal_segment_rows',
+                                                  1000))
+        codec = Codec() if config.get('compress_raw') else None
+        writer = Writer(connection, journal, codec,
+                        config.get('write_batch_size', 100),
+                        config.get('write_flush_interval', 1.0),
+                        config.get('write_queue_size', 10000),
+                        config.get('write_retry_interval', 10.0),
+                        metrics, config.get('dedup_size'),
+                        config.get('dedup_cache', 10000))
+        bot = LoggerBot(config, writer, metrics, 'replay', commands=False)
+        writer.start()
+
+        pushed = errors = 0
+        late = []
+        start = time.monotonic()
+        for due, direction, raw in schedule(frames, speed, rate):
+            wait = start + due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                late.append(-wait)
+            try:
+                if direction:
+                    bot.on_socket_raw_send(raw, False)
+                else:
+                    bot.on_socket_raw_receive(raw)
+            except Exception:
+                errors += 1
+            pushed += 1
+        pushed_time = time.monotonic() - start
+
+        writer.close()
+        written_time = time.monotonic() - start
+        spilled = sum(len(list(journal.read(path)))
+                      for path in journal.segments())
+
+    return {
+        'frames': pushed,
+        'errors': errors,
+        'inserted': connection.inserted,
+        'spilled': spilled,
+        'dropped': pushed - errors - connection.inserted - spilled,
+        'push_seconds': pushed_time,
+        'write_seconds': written_time,
+        'late': quantiles(late),
+        'late_frames': len(late),
+        'lag': quantiles(connection.lags),
+    }
+
+def report(results):
+    print("{} frames pushed in {:.2f} s, {:.0f} frames/s".format(
+        results['frames'], results['push_seconds'],
+        results['frames'] / max(results['push_seconds'], 1e-9)))
+    print("{} rows written in {:.2f} s, {:.0f} rows/s".format(
+        results['inserted'], results['write_seconds'],
+        results['inserted'] / max(results['write_seconds'], 1e-9)))
+    print("Behind schedule for {} frames, p50 {:.4f} s p99 {:.4f} s "
+          "max {:.4f} s".format(results['late_frames'], *results['late']))
+    print("Lag from logging to commit p50 {:.4f} s p99 {:.4f} s "
+          "max {:.4f} s".format(*results['lag']))
+    print("{} failed to log, {} spilled to the journal, {} dropped".format(
+        results['errors'], results['spilled'], results['dropped']))
+
+
+if __name__ == '__main__':
+    import argparse
+    import logging
+
+    from database import connect, load_config
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser(
+        'export', help="write logged messages to a file for replay")
+    export_parser.add_argument('file')
+    export_parser.add_argument('-w', '--where',
+                               help="only export messages matching this "
+                                    "WHERE clause")
+    export_parser.add_argument('-n', '--limit', type=int,
+                               help="most messages to export")
+
+    run_parser = subparsers.add_parser(
+        'run', help="replay frames through the logger")
+    run_parser.add_argument('file', nargs='?',
+                            help="frames written by export, or one raw "
+                                 "frame on each line")
+    run_parser.add_argument('-g', '--generate', metavar='FRAMES', type=int,
+                            help="replay this many generated frames instead "
+                                 "of a file")
+    pace = run_parser.add_mutually_exclusive_group()
+    pace.add_argument('-s', '--speed', type=float,
+                      help="replay at this many times the logged rate")
+    pace.add_argument('-r', '--rate', type=float,
+                      help="replay this many frames per second")
+    run_parser.add_argument('--insert-latency', type=float, default=0.002,
+                            help="seconds each insert takes")
+    run_parser.add_argument('--row-latency', type=float, default=0.00005,
+                            help="seconds each row adds to an insert")
+    run_parser.add_argument('--commit-latency', type=float, default=0.005,
+                            help="seconds each commit takes")
+    args = parser.parse_args()
+
+    # The writer settings of the config are used if there is one.
+    config = load_config() if os.path.exists('config.py') else {}
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.command == 'export':
+        export(connect(config), args.file, args.where, args.limit)
+    else:
+        if args.generate is not None:
+            frames = generate_frames(args.generate)
+        elif args.file is not None:
+            frames = read_frames(args.file)
+        else:
+            parser.error("either a file or --generate is needed")
+
+        connection = FakeConnection(args.insert_latency, args.row_latency,
+                                    args.commit_latency)
+        report(replay(config, frames, connection, args.speed, args.rate))
@@ -0,0 +1,70 @@
+"""Rebuild the rollup table of message counts from the logged messages.
+
+The logger keeps the rollup up to date as it inserts messages, this is
+for filling it in for messages logged by older versions, or after it
+has been changed by hand.  The table is replaced in a single
+transaction, which holds up the logger until it's done.  Rows logged
+before the size column existed count as 0 bytes unless backfill.py has
+been run first.
+"""
+
+import datetime
+import sys
+
+from archive import Archive
+from writer import ROLLUP_SQL, rollup_rows
+
+
+def rebuild(connection, archive=None, chunk_size=10000):
+    last_id = 0
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM rollup")
+
+        if archive is not None:
+            # Archived rows have to be summed up here as they are no
+            # longer in the database.
+            rows = []
+            for row in archive.read():
+                logged = datetime.datetime.strptime(row[1],
+                                                    '%Y-%m-%d %H:%M:%S')
+                # Rows of writer.make_row, without the raw text, which
+                # isn't counted.  Older segments have no session.
+                session = row[9] if len(row) > 9 else None
+                rows.append((logged,) + tuple(row[2:8]) + (session, None))
+                if len(rows) == chunk_size:
+                    cursor.executemany(ROLLUP_SQL, rollup_rows(rows))
+                    rows = []
+            cursor.executemany(ROLLUP_SQL, rollup_rows(rows))
+            last_id = archive.last_id
+
+        cursor.execute("INSERT INTO rollup (t, dir, op, minute, count, bytes) "
+                       "SELECT COALESCE(t, ''), dir, COALESCE(op, -1), "
+                       "time - INTERVAL SECOND(time) SECOND, COUNT(*), "
+                       "COALESCE(SUM(size), 0) FROM message WHERE id > %s "
+                       "GROUP BY 1, 2, 3, 4 ON DUPLICATE KEY UPDATE "
+                       "count = count + VALUES(count), "
+                       "bytes = bytes + VALUES(bytes)", (last_id,))
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(count), 0) FROM rollup")
+        minutes, total = cursor.fetchone()
+    connection.commit()
+
+    print("Rebuilt rollup with {} rows counting {} messages"
+          "".format(minutes, total), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    import argparse
+    import logging
+
+    from database import connect, load_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--archive', metavar='DIR',
+                        help="also count the messages archived to this "
+                             "directory")
+    args = parser.parse_args()
+
+    config = load_config()
+    logging.basicConfig(level=logging.INFO)
+    connection = connect(config)
+    rebuild(connection, Archive(args.archive) if args.archive else None)
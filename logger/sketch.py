@@ -0,0 +1,228 @@
+"""Fixed size statistics of the values seen at a node of the analysis.
+
+All of the statistics can be merged, and give the same result whatever
+order values are added or merged in, so partial results analyzed in
+parallel can be combined without replaying their values.
+"""
+
+import math
+import zlib
+
+
+# HyperLogLog with 2**PRECISION registers, which has a standard error of
+# about 1.04 / sqrt(2**PRECISION), or 6.5% here.
+PRECISION = 8
+REGISTERS = 1 << PRECISION
+
+# Bits in a value hash.
+HASH_BITS = 32
+
+# Version of the hashes, statistics made with different versions can't
+# be merged.
+HASH_VERSION = 2
+
+# Hashes are kept as they are until there are more than this many
+# distinct ones, which gives exact counts for nodes with few values.
+# The registers take less memory than a set of more hashes.
+SPARSE_LIMIT = 16
+
+# Number of values kept in the sample.
+SAMPLE_SIZE = 10
+
+
+# CRC-32 is much cheaper than a cryptographic hash, but similar values
+# get similar CRCs, so they are spread by multiplying with 2**64 divided
+# by the golden ratio and keeping the high bits.  Unlike hash() these
+# are the same in every run, so statistics saved by one run can be
+# merged in another.
+_GOLDEN = 0x9e3779b97f4a7c15
+_INT_START = zlib.crc32(b'int')
+
+def _spread(crc):
+    return (crc * _GOLDEN & 0xffffffffffffffff) >> 32
+
+_constant_hashes = {True: _spread(zlib.crc32(b'true')),
+                    False: _spread(zlib.crc32(b'false'))}
+_NONE_HASH = _spread(zlib.crc32(b'null'))
+
+def value_hash(leaf):
+    # Strings and ints start from different CRCs, so "1" and 1 differ,
+    # and True and 1 are told apart by their type.  _spread is inlined
+    # as this is called for most values.
+    t = type(leaf)
+    if t is str:
+        crc = zlib.crc32(leaf.encode('utf-8', 'surrogatepass'))
+    elif t is int:
+        crc = zlib.crc32(str(leaf).encode('ascii'), _INT_START)
+    elif leaf is None:
+        return _NONE_HASH
+    else:
+        return _constant_hashes[leaf]
+    return (crc * _GOLDEN & 0xffffffffffffffff) >> 32
+
+def length_bucket(length):
+    """Histogram bucket of a string length, 0, 1, 2-3, 4-7 and so on."""
+    return length.bit_length()
+
+def bucket_label(bucket):
+    if bucket < 2:
+        return str(bucket)
+    return '{}-{}'.format(1 << bucket - 1, (1 << bucket) - 1)
+
+
+class Stats:
+    """Distinct count, sample, string lengths and int range of values.
+
+    The sample holds the SAMPLE_SIZE values with the lowest hashes,
+    which is a uniform sample of the distinct values seen.  Until there
+    are more than SPARSE_LIMIT distinct values, hashes maps the hash of
+    each to the value and the sample is taken from it, after that the
+    distinct count is estimated from registers and the sample is kept
+    in sample, as a list of the values in hash order.  The hashes of the
+    sample are worked out again when needed, which is rare, rather than
+    kept.  Only one of hashes and registers is not None.
+    """
+
+    __slots__ = ('hashes', 'registers', 'sample', 'highest', 'lengths',
+                 'min', 'max')
+
+    def __init__(self):
+        self.hashes = {}
+        self.registers = None
+        self.sample = None
+        self.highest = 0
+        self.lengths = {}
+        self.min = None
+        self.max = None
+
+    # Most registers hold one of a few small ranks, so they are pickled
+    # compressed, in about half the space.
+    def __getstate__(self):
+        state = [getattr(self, name) for name in Stats.__slots__]
+        if self.registers is not None:
+            state[1] = zlib.compress(self.registers)
+        return tuple(state)
+
+    def __setstate__(self, state):
+        for name, value in zip(Stats.__slots__, state):
+            setattr(self, name, value)
+        if isinstance(self.registers, bytes):
+            self.registers = bytearray(zlib.decompress(self.registers))
+        if isinstance(self.hashes, set):
+            # Older versions kept a set of hashes and a sample of the
+            # lowest ones, which is all that is shown of the values.
+            sample = self.sample
+            self.hashes = {h: sample.get(h) for h in self.hashes}
+            self.sample = None
+        elif isinstance(self.sample, dict):
+            # And kept the sample by hash.
+            self.sample = [self.sample[h] for h in sorted(self.sample)]
+
+    def add(self, t, leaf, new=True):
+        """Add a value, new can be False if it is known to be added."""
+        if t == 'str':
+            # length_bucket, inlined as this is called for every value.
+            bucket = len(leaf).bit_length()
+            lengths = self.lengths
+            lengths[bucket] = lengths.get(bucket, 0) + 1
+        elif t == 'int':
+            if self.min is None:
+                self.min = self.max = leaf
+            elif leaf < self.min:
+                self.min = leaf
+            elif leaf > self.max:
+                self.max = leaf
+
+        if not new:
+            return
+
+        h = value_hash(leaf)
+        registers = self.registers
+        if registers is None:
+            hashes = self.hashes
+            if h not in hashes:
+                hashes[h] = leaf
+                if len(hashes) > SPARSE_LIMIT:
+                    self._densify()
+            return
+
+        index = h & REGISTERS - 1
+        rank = HASH_BITS - PRECISION - (h >> PRECISION).bit_length() + 1
+        if rank > registers[index]:
+            registers[index] = rank
+
+        # Most values are above all of the sample.
+        if h < self.highest:
+            self._sample([(h, leaf)])
+
+    def _register(self, h):
+        index = h & REGISTERS - 1
+        rest = h >> PRECISION
+        rank = HASH_BITS - PRECISION - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def _sample(self, values):
+        """Keep the values with the lowest hashes of the sample and
+        values, given as (hash, value) pairs.
+        """
+        sample = {value_hash(leaf): leaf for leaf in self.sample or ()}
+        sample.update(values)
+        lowest = sorted(sample)[:SAMPLE_SIZE]
+        self.sample = [sample[h] for h in lowest]
+        self.highest = lowest[-1] if lowest else 0
+
+    def _densify(self):
+        self.registers = bytearray(REGISTERS)
+        for h in self.hashes:
+            self._register(h)
+        self._sample(self.hashes.items())
+        self.hashes = None
+
+    def merge(self, other):
+        if other.registers is None and self.registers is None:
+            self.hashes.update(other.hashes)
+            if len(self.hashes) > SPARSE_LIMIT:
+                self._densify()
+        else:
+            if self.registers is None:
+                self._densify()
+            if other.registers is not None:
+                self.registers = bytearray(map(max, self.registers,
+                                               other.registers))
+                self._sample((value_hash(leaf), leaf)
+                             for leaf in other.sample)
+            else:
+                for h in other.hashes:
+                    self._register(h)
+                self._sample(other.hashes.items())
+
+        for bucket, count in other.lengths.items():
+            self.lengths[bucket] = self.lengths.get(bucket, 0) + count
+
+        if other.min is not None:
+            if self.min is None:
+                self.min, self.max = other.min, other.max
+            else:
+                self.min = min(self.min, other.min)
+                self.max = max(self.max, other.max)
+
+    def distinct(self):
+        """Estimated number of distinct values, and if it is exact."""
+        if self.registers is None:
+            return len(self.hashes), True
+
+        m = REGISTERS
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities.
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate)), False
+
+    def sample_values(self):
+        if self.registers is not None:
+            return list(self.sample)
+        hashes = self.hashes
+        return [hashes[h] for h in sorted(hashes)[:SAMPLE_SIZE]]
@@ -0,0 +1,37 @@
+"""Tests of the metrics, run with python -m unittest from the logger
+directory.
+"""
+
+import unittest
+
+import metrics
+
+
+class HistogramTest(unittest.TestCase):
+    def test_empty_quantile(self):
+        self.assertIsNone(metrics.Histogram().quantile(0.99))
+
+    def test_quantile(self):
+        histogram = metrics.Histogram()
+        for value in (0.0005, 0.003, 0.003, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.5), 0.005)
+        self.assertEqual(histogram.quantile(0.99), 2.5)
+
+
+class SummaryTest(unittest.TestCase):
+    def test_empty_summary(self):
+        summary = metrics.Metrics().summary()
+        self.assertIn("Insert p50 n/a p99 n/a, commit p50 n/a p99 n/a, "
+                      "lag p99 n/a.", summary)
+
+    def test_summary(self):
+        m = metrics.Metrics()
+        m.written([(0, None)], 0.002, 0.02)
+        summary = m.summary()
+        self.assertIn("Insert p50 0.0025s p99 0.0025s, "
+                      "commit p50 0.025s p99 0.025s", summary)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+"""Tests of the paging of the query service, run with
+python -m unittest from the logger directory.
+"""
+
+import json
+import re
+import unittest
+
+import query
+
+
+class FakeCursor:
+    """Runs the queries of the service on fixed results.
+
+    Queries are looked up in the results of the connection, and the
+    paging and limits the service wraps them in are applied here.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, sql, args=None):
+        self.connection.executed.append(sql)
+        if sql == "SHOW TABLES":
+            self.rows = [('message',), ('keyindex',), ('rollup',)]
+            return
+        if sql == "SELECT MIN(id), MAX(id) FROM message":
+            self.rows = [(1, 100)]
+            return
+
+        after = limit = None
+        page = re.fullmatch(r'SELECT \* FROM \((.*)\) page WHERE '
+                            r'page.id > %s ORDER BY page.id LIMIT %s', sql)
+        if page is not None:
+            sql = page.group(1)
+            after, limit = args
+        elif sql.endswith(" LIMIT %s"):
+            sql = sql[:-len(" LIMIT %s")]
+            limit = args[0]
+        sql = sql.replace('%%', '%')
+
+        fields, rows = self.connection.fields, self.connection.results[sql]
+        if after is not None:
+            rows = sorted((row for row in rows if row[0] > after),
+                          key=lambda row: row[0])
+        if limit is not None:
+            rows = rows[:limit]
+        self.description = [(name, 3) for name in fields]
+        self.rows = list(rows)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+
+class FakeConnection:
+    def __init__(self, fields, results):
+        self.fields = fields
+        self.results = results
+        self.executed = []
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get(self):
+        return self.connection
+
+    def put(self, connection, broken=False):
+        pass
+
+
+def read_pages(service, sql, limit):
+    """Rows of every page of a query, and the last line of the last."""
+    rows, after = [], 0
+    while True:
+        lines = [json.loads(line) for line in service.query(sql, after,
+                                                              limit)]
+        rows.extend(lines[1:-1])
+        after = lines[-1]['next']
+        if after is None:
+            return rows, lines[-1]
+
+
+class PagingTest(unittest.TestCase):
+    def service(self, results):
+        connection = FakeConnection(['id', 'value'], results)
+        return query.QueryService(FakePool(connection)), connection
+
+    def test_pages_message_by_id(self):
+        sql = "SELECT * FROM message"
+        rows = [[i, str(i)] for i in range(1, 8)]
+        service, connection = self.service({sql: rows})
+        pages, last = read_pages(service, sql, 3)
+        self.assertEqual(pages, rows)
+        self.assertFalse(last['more'])
+
+    def test_duplicate_ids_across_page_boundary(self):
+        # A message with several values at one path repeats its id, and
+        # a page of 2 ends between the rows with id 2.
+        sql = "SELECT * FROM keyindex WHERE path = 'd.mentions.id'"
+        rows = [[1, 'a'], [2, 'b'], [2, 'c'], [2, 'd'], [3, 'e']]
+        service, connection = self.service({sql: rows})
+        pages, last = read_pages(service, sql, 2)
+        # Not paged, so no row is skipped, and the result is cut off.
+        self.assertEqual(pages, rows[:2])
+        self.assertTrue(last['more'])
+        self.assertFalse(any('page.id' in executed
+                             for executed in connection.executed))
+
+    def test_join_is_not_paged(self):
+        sql = "SELECT * FROM message JOIN keyindex USING (id)"
+        rows = [[1, 'a'], [1, 'b'], [1, 'c'], [2, 'd']]
+        service, connection = self.service({sql: rows})
+        pages, last = read_pages(service, sql, 2)
+        self.assertEqual(pages, rows[:2])
+        self.assertTrue(last['more'])
+
+    def test_unpaged_query_is_limited(self):
+        sql = "SELECT * FROM message ORDER BY time DESC"
+        rows = [[i, str(i)] for i in range(10, 0, -1)]
+        service, connection = self.service({sql: rows})
+        pages, last = read_pages(service, sql, 4)
+        self.assertEqual(pages, rows[:4])
+        self.assertTrue(last['more'])
+        self.assertIn(sql + " LIMIT %s", connection.executed)
+
+
+class CacheTest(unittest.TestCase):
+    def service(self, results):
+        connection = FakeConnection(['minute', 'count'], results)
+        return query.QueryService(FakePool(connection)), connection
+
+    def test_rollup_is_cached(self):
+        sql = "SELECT minute, SUM(count) FROM rollup GROUP BY minute"
+        service, connection = self.service({sql: [[1, 10], [2, 20]]})
+        first = list(service.query(sql, 0, 10))
+        second = list(service.query(sql, 0, 10))
+        self.assertEqual(first, second)
+        self.assertEqual(sum(executed.startswith(sql)
+                             for executed in connection.executed), 1)
+
+    def test_other_tables_are_not_cached(self):
+        sql = "SELECT id, value FROM keyindex"
+        service, connection = self.service({sql: [[1, 'a']]})
+        list(service.query(sql, 0, 10))
+        list(service.query(sql, 0, 10))
+        self.assertEqual(sum(executed.startswith(sql)
+                             for executed in connection.executed), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
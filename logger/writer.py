@@ -0,0 +1,340 @@
+"""Background writer that inserts logged messages into the database."""
+
+import collections
+import datetime
+import json
+import logging
+import queue
+import threading
+import time
+
+import pymysql
+
+from codec import REFERENCE, payload_hash
+from journal import segment_name
+from partition import partition
+
+
+INSERT_SQL = ("INSERT INTO message "
+              "(time, dir, op, s, t, part, size, session, raw) "
+              "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)")
+
+PAYLOAD_SQL = "INSERT IGNORE INTO payload (hash, raw) VALUES (%s, %s)"
+
+# Seconds a payload is remembered as stored after a message last
+# referred to it.  archive.py deletes payloads that only archived
+# messages refer to, so a payload remembered for longer than
+# archive_after_days could have been deleted.
+DEDUP_MAX_AGE = 24 * 60 * 60
+
+ROLLUP_SQL = ("INSERT INTO rollup (t, dir, op, minute, count, bytes) "
+              "VALUES (%s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE "
+              "count = count + VALUES(count), bytes = bytes + VALUES(bytes)")
+
+
+def make_row(is_send, raw, data, session=None):
+    """Build the row inserted for a message from its decoded data."""
+    op = s = t = None
+    if 'op' in data and 'd' in data:
+        op = data['op']
+        if 's' in data:
+            s = data['s']
+            if 't' in data:
+                t = data['t']
+
+    # The row is written later, so the time has to be recorded here.
+    return (time.time(), int(is_send), op, s, t,
+            message_partition(int(is_send), data), len(raw.encode('utf-8')),
+            session, raw)
+
+def rollup_rows(rows):
+    """Sum up message rows into rollup rows, NULL t and op as '' and -1."""
+    totals = {}
+    for logged, direction, op, s, t, part, size, session, raw in rows:
+        minute = logged.replace(second=0, microsecond=0)
+        key = ('' if t is None else t, direction, -1 if op is None else op,
+               minute)
+        count, total = totals.get(key, (0, 0))
+        totals[key] = (count + 1, total + (size or 0))
+    return [key + value for key, value in totals.items()]
+
+def message_partition(direction, data):
+    # Messages that are not shaped as expected are logged without one.
+    try:
+        return partition(direction, data)
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+def upgrade_row(row):
+    """Add the columns missing from a row journaled by older versions."""
+    if len(row) == 6:
+        logged, direction, op, s, t, raw = row
+        try:
+            part = message_partition(direction, json.loads(raw))
+        except ValueError:
+            part = None
+        row = (logged, direction, op, s, t, part, len(raw.encode('utf-8')),
+               raw)
+    if len(row) == 8:
+        row = row[:7] + (None, row[7])
+    return row
+
+
+class Writer(threading.Thread):
+    """Drains a queue of rows into the database in batches.
+
+    Rows are inserted with a multi-row insert and committed once per
+    batch.  A batch is written when it reaches batch_size rows or when
+    the oldest row in it has waited flush_interval seconds.
+
+    When the queue is full or the database fails, rows are spilled to
+    the journal instead.  From then on all new rows go to the journal
+    until it has been replayed, so rows are always inserted in the
+    order they were logged.  Rows can be put from any number of
+    threads, such as the sessions of a supervisor.
+
+    If dedup_size is set, messages of at least that many bytes are
+    stored once in the payload table and referenced by their hash.  The
+    hashes of the last dedup_cache payloads committed are remembered to
+    skip storing them again, for up to DEDUP_MAX_AGE seconds after they
+    were last referred to.
+    """
+
+    def __init__(self, connection, journal, codec, batch_size=100,
+                 flush_interval=1.0, queue_size=10000, retry_interval=10.0,
+                 metrics=None, dedup_size=None, dedup_cache=10000):
+        threading.Thread.__init__(self, name='Writer', daemon=True)
+        self.connection = connection
+        self.journal = journal
+        self.codec = codec
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.metrics = metrics
+        self.dedup_size = dedup_size
+        self.dedup_cache = dedup_cache
+        self._payloads = collections.OrderedDict()
+        self._new_payloads = set()
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self._closing = False
+        self._retry_at = 0
+
+        # Rows left over from the last run go before any new rows.
+        self.spilling = bool(journal.segments())
+
+    def put(self, row):
+        with self.lock:
+            if not self.spilling:
+                try:
+                    self.queue.put_nowait(row)
+                    return
+                except queue.Full:
+                    logging.warning("Write queue full, spilling to journal")
+                    self.spilling = True
+
+            self.journal.append(row)
+
+    def close(self):
+        """Flush all queued rows and stop the writer."""
+        self._closing = True
+        self.join()
+        self.journal.seal()
+
+    def run(self):
+        while True:
+            try:
+                self._step()
+            except Exception:
+                # The writer has to keep going whatever goes wrong, or
+                # nothing is logged from then on.
+                logging.exception("Writer failed, retrying in %s seconds",
+                                  self.retry_interval)
+                self._retry_at = time.monotonic() + self.retry_interval
+
+            if self._closing and self.queue.empty():
+                break
+
+    def _step(self):
+        batch = self._collect()
+        if batch and not self._write(batch):
+            self._spill(batch)
+
+        # Rows in the queue are older than the journal, so the journal
+        # is only replayed once the queue is empty.
+        if (self.spilling and self.queue.empty()
+                and time.monotonic() >= self._retry_at and not self._closing):
+            self._replay()
+
+    def _collect(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0 and not self._closing:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _insert(self, cursor, batch):
+        rows = [(utc(r[0]),) + tuple(upgrade_row(r)[1:]) for r in batch]
+        totals = rollup_rows(rows)
+        payloads = []
+        if self.dedup_size is not None:
+            rows = [self._dedup(r, payloads) if r[6] >= self.dedup_size
+                    else r for r in rows]
+        if self.codec is not None:
+            encode = self.codec.encode
+            payloads = [(h, encode(raw)) for h, raw in payloads]
+            rows = [r if isinstance(r[8], bytes) else r[:8] + (encode(r[8]),)
+                    for r in rows]
+
+        # Payloads may have been stored by an earlier run.
+        cursor.executemany(PAYLOAD_SQL, payloads)
+        cursor.executemany(INSERT_SQL, rows)
+        # The rollup is updated in the same transaction as the rows it
+        # counts, so every row is counted exactly once.
+        cursor.executemany(ROLLUP_SQL, totals)
+
+    def _dedup(self, row, payloads):
+        digest = payload_hash(row[8])
+        if digest not in self._new_payloads:
+            referred = self._payloads.get(digest)
+            if (referred is None
+                    or time.monotonic() - referred > DEDUP_MAX_AGE):
+                payloads.append((digest, row[8]))
+            self._new_payloads.add(digest)
+        return row[:8] + (REFERENCE + digest,)
+
+    def _committed(self):
+        # Payloads are only known to be stored, and referred to by a
+        # message, once they are committed.
+        now = time.monotonic()
+        for digest in self._new_payloads:
+            self._payloads[digest] = now
+            self._payloads.move_to_end(digest)
+        self._new_payloads.clear()
+        while len(self._payloads) > self.dedup_cache:
+            self._payloads.popitem(last=False)
+
+    def _write(self, batch):
+        try:
+            start = time.monotonic()
+            with self.connection.cursor() as cursor:
+                self._insert(cursor, batch)
+            inserted = time.monotonic()
+            self.connection.commit()
+            self._committed()
+            self._record(batch, start, inserted)
+            return True
+        except pymysql.MySQLError:
+            logging.exception("Failed to write %d messages", len(batch))
+            self._rollback()
+            return False
+        except Exception:
+            # Most likely a row that can't be written, its journal
+            # segment is set aside when it's replayed.
+            logging.exception("Unexpected error writing %d messages",
+                              len(batch))
+            self._rollback()
+            return False
+
+    def _spill(self, batch):
+        with self.lock:
+            self.spilling = True
+            self._retry_at = time.monotonic() + self.retry_interval
+
+            # The batch and the queue are older than anything already
+            # in the journal, so they go in front of it.
+            rows = list(batch)
+            while True:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.journal.prepend(rows)
+            except Exception:
+                logging.exception("Failed to spill %d messages to the "
+                                  "journal, they are lost", len(rows))
+
+    def _replay(self):
+        try:
+            self.connection.ping(reconnect=True)
+        except pymysql.MySQLError:
+            logging.warning("Database unavailable, retrying in %s seconds",
+                            self.retry_interval)
+            self._retry_at = time.monotonic() + self.retry_interval
+            return
+
+        while not self._closing:
+            with self.lock:
+                segments = self.journal.seal()
+                if not segments:
+                    logging.info("Journal replayed")
+                    self.spilling = False
+                    return
+
+            for segment in segments:
+                if self._closing or not self._replay_segment(segment):
+                    return
+
+    def _replay_segment(self, path):
+        name = segment_name(path)
+        try:
+            rows = list(self.journal.read(path))
+            with self.connection.cursor() as cursor:
+                # The segment name is recorded in the same transaction
+                # as its rows, so a segment is never inserted twice.
+                cursor.execute("SELECT name FROM journal_segment "
+                               "WHERE name = %s", (name,))
+                start = time.monotonic()
+                if cursor.fetchone() is None:
+                    for i in range(0, len(rows), self.batch_size):
+                        self._insert(cursor, rows[i:i+self.batch_size])
+                    cursor.execute("INSERT INTO journal_segment (name) "
+                                   "VALUES (%s)", (name,))
+            inserted = time.monotonic()
+            self.connection.commit()
+            self._committed()
+            if rows:
+                self._record(rows, start, inserted)
+
+        except (pymysql.OperationalError, pymysql.InterfaceError):
+            logging.exception("Failed to replay journal segment %s", name)
+            self._rollback()
+            self._retry_at = time.monotonic() + self.retry_interval
+            return False
+
+        except Exception:
+            # Errors other than from the connection are from the rows,
+            # which would fail the same way every time.
+            logging.exception("Setting aside journal segment %s", name)
+            self._rollback()
+            self.journal.set_aside(path)
+            return True
+
+        self.journal.remove(path)
+        return True
+
+    def _record(self, rows, start, inserted):
+        if self.metrics is not None:
+            self.metrics.written(rows, inserted - start,
+                                 time.monotonic() - inserted)
+
+    def _rollback(self):
+        self._new_payloads.clear()
+        try:
+            self.connection.rollback()
+        except pymysql.MySQLError:
+            pass
+
+
+def utc(timestamp):
+    # The writer connection uses UTC as its session time zone.
+    return datetime.datetime.utcfromtimestamp(timestamp)
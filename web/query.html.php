@@ -4,58 +4,54 @@ function html($text) {
     return htmlspecialchars($text, ENT_QUOTES|ENT_HTML5, 'UTF-8');
 }
 
-$host = $_SERVER['DB_HOST'];
-$user = $_SERVER['DB_USER'];
-$password = $_SERVER['DB_PASSWORD'];
-$schema = $_SERVER['DB_SCHEMA'];
-
-$mysqli = new mysqli($host, $user, $password, $schema);
-if ($mysqli->connect_errno) {
-    header("HTTP/1.0 500 Internal Server Error");
-    echo("500 Internal Server Error\n");
-    echo("Failed to connect to database: ".$mysqli->connect_error);
-    die();
+// Read the next line of a result from the query service, see
+// logger/query.py.
+function read_line($stream) {
+    $line = fgets($stream);
+    if ($line === false) {
+        return false;
+    }
+    return json_decode($line, true);
 }
 
 if (!array_key_exists('query', $_GET) || $_GET['query'] === '') {
-    $query = "SELECT t, COUNT(*) FROM message GROUP BY t ORDER BY t";
+    // Counting from the rollup avoids scanning the message table.
+    $query = "SELECT NULLIF(t, '') AS t, SUM(count) AS count, SUM(bytes) AS bytes FROM rollup GROUP BY t ORDER BY t";
 } else {
     $query = $_GET['query'];
 }
+$after = array_key_exists('after', $_GET) ? (int)$_GET['after'] : 0;
+
+$url = $_SERVER['QUERY_SERVICE'].'/query?'.http_build_query(array(
+    "q" => $query,
+    "after" => $after,
+    "limit" => 1000,
+));
+$context = stream_context_create(array("http" => array("ignore_errors" => true)));
 
 $fields = array();
 $error = false;
-if ($res = $mysqli->query($query, MYSQLI_USE_RESULT)) {
-    $fno = 0;
-    while ($finfo = $res->fetch_field()) {
+$stream = @fopen($url, 'r', false, $context);
+if ($stream === false) {
+    header("HTTP/1.0 500 Internal Server Error");
+    echo("500 Internal Server Error\n");
+    echo("Failed to connect to the query service");
+    die();
+}
+
+$header = read_line($stream);
+if ($header === false || array_key_exists('error', $header)) {
+    $error = $header === false ? "No response from the query service." : $header['error'];
+} else {
+    foreach ($header['fields'] as $index => $field) {
         $fields[] = array(
-            "index" => $fno++,
-            "name" => $finfo->name,
-            "type" => $finfo->type,
+            "index" => $index,
+            "name" => $field['name'],
+            "type" => $field['type'],
         );
     }
-
-    $rows_fetched = 0;
-    while ($rows_fetched < 1000) {
-        if (($row = $res->fetch_row()) !== null) {
-            $dataset[] = $row;
-            $rows_fetched++;
-        } else {
-            break;
-        }
-    }
-
-    if ($rows_fetched === 0) {
-        $error = "Query returned an empty set of results.";
-    }
-
-    $result_limited = $rows_fetched === 1000 && $res->fetch_row() !== null;
-} else {
-    $error = $mysqli->error;
 }
 
-$mysqli->close();
-
 ?>
 <!DOCTYPE html>
 <html>
@@ -94,13 +90,6 @@ $mysqli->close();
                 <button type="submit" id="query-button" class="btn btn-default">Run MySQL Query</button>
             </form>
 <?php
-if ($result_limited) { ?>
-            <div class="alert alert-info">
-                <strong>Note:</strong> Only the first 1000 results of the query is shown.
-            </div>
-<?php
-}
-
 if ($error !== false) { ?>
             <div class="alert alert-danger">
                 <?=html($error)?>
@@ -119,7 +108,10 @@ if ($error !== false) { ?>
                 </tr>
 <?php
 
-    foreach ($dataset as $row) { ?>
+    // Rows are shown as they are read, the last line isn't a row.
+    $rows = 0;
+    while (($row = read_line($stream)) !== false && !array_key_exists('more', $row)) {
+        $rows++; ?>
                 <tr>
 <?php
         foreach ($fields as $field) {
@@ -128,33 +120,69 @@ if ($error !== false) { ?>
                     <td class="sql-null">NULL</td>
 <?php
             } else if ($field["name"] === "raw") {
-                $decoded = json_decode($value);
-                if ($decoded !== null) {
-                    $value = json_encode($decoded, JSON_PRETTY_PRINT);
-                } else {
-                    $value = implode("\n", str_split($value, 80));
-                } ?>
+                // Indented by the browser when it's scrolled into view. ?>
                     <td>
-<pre><?=html($value)?></pre>
+<pre class="raw"><?=html($value)?></pre>
                     </td>
 <?php
             } else {
                 if ($field["name"] === "dir") {
-                    if ($value === "0") {
+                    if ((string)$value === "0") {
                         $value = "Receive";
-                    } else if ($value === "1") {
+                    } else if ((string)$value === "1") {
                         $value = "Send";
                     }
                 } ?>
-                    <td><?=html($value)?></td>
+                    <td><?=html((string)$value)?></td>
 <?php
             }
         } ?>
                 </tr>
 <?php
-    }
-} ?>
+    } ?>
             </table>
         </div>
+        <div class="container">
+<?php
+    if ($rows === 0) { ?>
+            <div class="alert alert-info">
+                Query returned an empty set of results.
+            </div>
+<?php
+    } else if ($row !== false && $row['next'] !== null) { ?>
+            <ul class="pager">
+                <li><a href="query?<?=html(http_build_query(array("query" => $query, "after" => $row['next'])))?>">Next page</a></li>
+            </ul>
+<?php
+    } else if ($row !== false && $row['more']) { ?>
+            <div class="alert alert-info">
+                <strong>Note:</strong> Only the first 1000 results of the query is shown, query the message table alone with its id column to page through all of them.
+            </div>
+<?php
+    } ?>
+        </div>
+<?php
+}
+fclose($stream); ?>
+        <script>
+            // Pretty print JSON, or break up other text, once in view.
+            var observer = new IntersectionObserver(function (entries) {
+                entries.forEach(function (entry) {
+                    if (!entry.isIntersecting) {
+                        return;
+                    }
+                    var pre = entry.target;
+                    observer.unobserve(pre);
+                    try {
+                        pre.textContent = JSON.stringify(JSON.parse(pre.textContent), null, 4);
+                    } catch (e) {
+                        pre.textContent = (pre.textContent.match(/.{1,80}/g) || []).join("\n");
+                    }
+                });
+            });
+            document.querySelectorAll("pre.raw").forEach(function (pre) {
+                observer.observe(pre);
+            });
+        </script>
     </body>
 </head>